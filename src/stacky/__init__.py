@@ -1,3 +1,4 @@
+from .__about__ import __version__
 from .stacky import main
 
 
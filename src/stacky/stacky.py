@@ -24,8 +24,11 @@
 #
 # That's all there is to it.
 
+import atexit
+import bisect
 import configparser
 import dataclasses
+import functools
 import json
 import logging
 import os
@@ -33,13 +36,28 @@ import re
 import shlex
 import subprocess
 import sys
+import tempfile
 import time
 from argparse import ArgumentParser
-from typing import Dict, FrozenSet, Generator, List, NewType, Optional, Tuple, TypedDict, Union
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, FrozenSet, Generator, List, NewType, NoReturn, Optional, Tuple, TypedDict, Union
+
+try:
+    # orjson is optional (the "json" extra), it is a lot faster on large gh payloads
+    from orjson import loads as json_loads  # type: ignore
+except ImportError:
+    json_loads = json.loads  # type: ignore[assignment]
+
+try:
+    import colors  # type: ignore
+except ImportError:
+    # ansicolors is optional (the "color" extra), without it nothing is colorized
+    class colors:  # type: ignore
+        @staticmethod
+        def color(s, **kwargs):
+            return s
 
-import asciitree  # type: ignore
-import colors  # type: ignore
-from simple_term_menu import TerminalMenu  # type: ignore
 
 BranchName = NewType("BranchName", str)
 PathName = NewType("PathName", str)
@@ -49,6 +67,8 @@ StackSubTree = Tuple["StackBranch", "BranchesTree"]
 TreeNode = Tuple[BranchName, StackSubTree]
 BranchesTree = NewType("BranchesTree", Dict[BranchName, StackSubTree])
 BranchesTreeForest = NewType("BranchesTreeForest", List[BranchesTree])
+# Full ref name (ie. refs/heads/foo) -> commit, None if the ref doesn't exist
+RefsSnapshot = Dict[str, Optional[Commit]]
 
 JSON = Union[Dict[str, "JSON"], List["JSON"], str, int, float, bool, None]
 
@@ -77,6 +97,33 @@ class BranchNCommit:
     parent_commit: Optional[str]
 
 
+# Bumped when the meaning of STATE_FILE changes, files written before the
+# version was recorded are version 1
+SYNC_STATE_VERSION = 2
+
+
+# What `stacky continue` needs to resume a sync, saved in STATE_FILE
+@dataclasses.dataclass
+class SyncState:
+    branch: BranchName
+    # Branches left to sync, in order
+    sync: List[BranchName]
+    version: int = SYNC_STATE_VERSION
+
+
+def parse_sync_state(data: Any) -> SyncState:
+    if not isinstance(data, dict):
+        raise ValueError("expected an object")
+    version = data.get("version", 1)
+    if version == 1:
+        # Version 1 listed the branches left to sync last to sync first
+        info("Converting state file from an older stacky")
+        data = dict(data, sync=list(reversed(data["sync"])), version=SYNC_STATE_VERSION)
+    elif version != SYNC_STATE_VERSION:
+        raise ValueError("unsupported version {}, written by a newer stacky?".format(version))
+    return SyncState(**data)
+
+
 _LOGGING_FORMAT = "%(asctime)s %(module)s %(levelname)s: %(message)s"
 
 # 2 minutes ought to be enough for anybody ;-)
@@ -85,10 +132,20 @@ COLOR_STDOUT: bool = os.isatty(1)
 COLOR_STDERR: bool = os.isatty(2)
 IS_TERMINAL: bool = os.isatty(1) and os.isatty(2)
 CURRENT_BRANCH: BranchName
-STACK_BOTTOMS: set[BranchName] = set([BranchName("master"), BranchName("main")])
 FROZEN_STACK_BOTTOMS: FrozenSet[BranchName] = frozenset([BranchName("master"), BranchName("main")])
+# Frozen bottoms plus the ones recorded in refs/stacky-bottom-branch, set once
+# by load_all_stacks
+STACK_BOTTOMS: FrozenSet[BranchName] = FROZEN_STACK_BOTTOMS
 STATE_FILE = os.path.expanduser("~/.stacky.state")
-TMP_STATE_FILE = STATE_FILE + ".tmp"
+PR_CACHE_FILE = os.path.expanduser("~/.stacky.prcache.json")
+PR_CACHE_ENABLED: bool = True
+# How long cached PR info is trusted, PRs also change without their branch moving
+PR_CACHE_LIFETIME = 600
+# Touched after a successful `gh auth status`, which we then skip for a while
+AUTH_CACHE_FILE = os.path.expanduser("~/.stacky.authcache")
+AUTH_CACHE_LIFETIME = 600
+# Bumped by each do_sync, see StackBranch._sync_epoch
+_SYNC_EPOCH = 0
 
 LOGLEVELS = {
     "critical": logging.CRITICAL,
@@ -108,6 +165,7 @@ class StackyConfig:
     share_ssh_session: bool = False
     use_merge: bool = False
     use_force_push: bool = True
+    write_commit_graph: bool = True
 
     def read_one_config(self, config_path: str):
         rawconfig = configparser.ConfigParser()
@@ -121,6 +179,9 @@ class StackyConfig:
         if rawconfig.has_section("GIT"):
             self.use_merge = bool(rawconfig.get("GIT", "use_merge", fallback=self.use_merge))
             self.use_merge = bool(rawconfig.get("GIT", "use_force_push", fallback=self.use_force_push))
+            self.write_commit_graph = rawconfig.getboolean(
+                "GIT", "write_commit_graph", fallback=self.write_commit_graph
+            )
 
 
 CONFIG: Optional[StackyConfig] = None
@@ -154,24 +215,32 @@ def cout(*args, **kwargs):
     return sys.stdout.write(fmt(*args, color=COLOR_STDOUT, **kwargs))
 
 
-def _log(fn, *args, **kwargs):
-    return fn("%s", fmt(*args, color=COLOR_STDERR, **kwargs))
+def _log(level, *args, **kwargs):
+    # Don't bother formatting messages nobody will see
+    if logging.getLogger().isEnabledFor(level):
+        logging.log(level, "%s", fmt(*args, color=COLOR_STDERR, **kwargs))
 
 
 def debug(*args, **kwargs):
-    return _log(logging.debug, *args, fg="green", **kwargs)
+    return _log(logging.DEBUG, *args, fg="green", **kwargs)
 
 
 def info(*args, **kwargs):
-    return _log(logging.info, *args, fg="green", **kwargs)
+    return _log(logging.INFO, *args, fg="green", **kwargs)
 
 
 def warning(*args, **kwargs):
-    return _log(logging.warning, *args, fg="yellow", **kwargs)
+    return _log(logging.WARNING, *args, fg="yellow", **kwargs)
 
 
 def error(*args, **kwargs):
-    return _log(logging.error, *args, fg="red", **kwargs)
+    return _log(logging.ERROR, *args, fg="red", **kwargs)
+
+
+def debug_command(cmd: List[str]):
+    # shlex.join isn't free, only quote the command when it will be logged
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        debug("Running: {}", shlex.join(cmd))
 
 
 class ExitException(BaseException):
@@ -190,7 +259,7 @@ def stop_muxed_ssh(remote: str = "origin"):
             subprocess.Popen(cmd, stderr=subprocess.DEVNULL)
 
 
-def die(*args, **kwargs):
+def die(*args, **kwargs) -> NoReturn:
     # We are taking a wild guess at what is the remote ...
     # TODO (mpatou) fix the assumption about the remote
     stop_muxed_ssh()
@@ -201,21 +270,31 @@ def _check_returncode(sp: subprocess.CompletedProcess, cmd: CmdArgs):
     rc = sp.returncode
     if rc == 0:
         return
-    stderr = sp.stderr.decode("UTF-8")
+    if cmd and cmd[0] == "gh":
+        # Maybe we're not authenticated anymore, check again next time
+        forget_gh_auth()
+    stderr = sp.stderr
     if rc < 0:
         die("Killed by signal {}: {}. Stderr was:\n{}", -rc, shlex.join(cmd), stderr)
     else:
         die("Exited with status {}: {}. Stderr was:\n{}", rc, shlex.join(cmd), stderr)
 
 
-def run_multiline(cmd: CmdArgs, *, check: bool = True, null: bool = True, out: bool = False) -> Optional[str]:
-    debug("Running: {}", shlex.join(cmd))
+def run_multiline(
+    cmd: CmdArgs, *, check: bool = True, null: bool = True, out: bool = False, input: Optional[str] = None
+) -> Optional[str]:
+    if cmd[0] == "git":
+        GIT_BATCH.flush()
+    debug_command(cmd)
     sys.stdout.flush()
     sys.stderr.flush()
     sp = subprocess.run(
         cmd,
         stdout=1 if out else subprocess.PIPE,
         stderr=subprocess.PIPE,
+        input=input,
+        encoding="UTF-8",
+        errors="replace",
     )
     if check:
         _check_returncode(sp, cmd)
@@ -224,7 +303,143 @@ def run_multiline(cmd: CmdArgs, *, check: bool = True, null: bool = True, out: b
         return None
     if sp.stdout is None:
         return ""
-    return sp.stdout.decode("UTF-8")
+    return sp.stdout
+
+
+def run_lines(cmd: CmdArgs, *, check: bool = True) -> List[str]:
+    """Run cmd and return the non empty lines of its output, decoding them as
+    they are read rather than materializing the whole output first
+    """
+    if cmd[0] == "git":
+        GIT_BATCH.flush()
+    debug_command(cmd)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # stderr goes to a file: with a pipe, the command would block once it
+    # filled it while we are still reading stdout
+    with tempfile.TemporaryFile() as err:
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err, encoding="UTF-8", errors="replace") as sp:
+            assert sp.stdout is not None
+            lines = [line.rstrip("\n") for line in sp.stdout if line != "\n"]
+            rc = sp.wait()
+        err.seek(0)
+        stderr = err.read().decode("UTF-8", errors="replace")
+    if check:
+        _check_returncode(subprocess.CompletedProcess(cmd, rc, None, stderr), cmd)
+    return lines if rc == 0 else []
+
+
+class GitBatch:
+    """Resolves refs through a single long running `git cat-file` and queues
+    ref updates to apply them with a single `git update-ref --stdin`, instead
+    of forking git for each of them.
+
+    Queued updates are applied before resolving a ref or running any other
+    git command, so that git always sees them. Whatever is still queued when
+    stacky exits is applied by close(), which main() calls however the
+    command ended; only a hard kill loses it.
+
+    Resolved refs are remembered, along with the snapshot taken when loading
+    the stacks and our own updates, until forget() is called because
+    something else (rebase, commit, fetch...) may have changed them.
+    """
+
+    def __init__(self) -> None:
+        self._cat_file: Optional[subprocess.Popen] = None
+        self._cat_file_contents: Optional[subprocess.Popen] = None
+        self._updates: List[str] = []
+        self._updated_refs: set[str] = set()
+        self._refs: RefsSnapshot = {}
+
+    def remember(self, refs: RefsSnapshot):
+        self._refs.update(refs)
+
+    def forget(self):
+        self._refs = {}
+
+    def resolve(self, ref: str) -> Optional[Commit]:
+        if ref in self._refs:
+            return self._refs[ref]
+        self.flush()
+        if self._cat_file is None:
+            cmd = CmdArgs(["git", "cat-file", "--batch-check=%(objectname)"])
+            debug_command(cmd)
+            self._cat_file = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, encoding="UTF-8", errors="replace"
+            )
+        assert self._cat_file.stdin is not None and self._cat_file.stdout is not None
+        self._cat_file.stdin.write(ref + "\n")
+        self._cat_file.stdin.flush()
+        line = self._cat_file.stdout.readline().rstrip("\n")
+        if not line:
+            die("git cat-file exited unexpectedly while resolving {}", ref)
+        # Unresolvable refs are echoed back as "<ref> missing"
+        commit = None if " " in line else Commit(line)
+        self._refs[ref] = commit
+        return commit
+
+    def commit_message(self, commit: Commit) -> str:
+        """The message of a commit, read through a single long running
+        `git cat-file --batch` rather than a `git log` per commit
+        """
+        if self._cat_file_contents is None:
+            cmd = CmdArgs(["git", "cat-file", "--batch"])
+            debug_command(cmd)
+            self._cat_file_contents = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        assert self._cat_file_contents.stdin is not None and self._cat_file_contents.stdout is not None
+        self._cat_file_contents.stdin.write(commit.encode() + b"\n")
+        self._cat_file_contents.stdin.flush()
+        # <sha> <type> <size>\n<contents>\n, or <sha> missing\n
+        header = self._cat_file_contents.stdout.readline().split()
+        if len(header) != 3 or header[1] != b"commit":
+            die("Cannot read commit {}", commit)
+        contents = self._cat_file_contents.stdout.read(int(header[2]) + 1)[:-1]
+        # The message follows the headers and a blank line
+        return contents.partition(b"\n\n")[2].decode("UTF-8", errors="replace")
+
+    def _queue(self, ref: str, command: str):
+        if ref in self._updated_refs:
+            # A ref can only be updated once per transaction
+            self.flush()
+        self._updates.append(command)
+        self._updated_refs.add(ref)
+        self._refs.pop(ref, None)
+
+    def update_ref(self, ref: str, new_commit: Commit, prev_commit: Optional[str] = None):
+        """Like `git update-ref ref new_commit [prev_commit]`, "" as prev_commit
+        means that the ref must not exist yet
+        """
+        if prev_commit == "":
+            prev_commit = "0" * len(new_commit)
+        self._queue(ref, "update {}\0{}\0{}\0".format(ref, new_commit, prev_commit or ""))
+        self._refs[ref] = new_commit
+
+    def delete_ref(self, ref: str):
+        self._queue(ref, "delete {}\0\0".format(ref))
+        self._refs[ref] = None
+
+    def flush(self):
+        if not self._updates:
+            return
+        updates = "".join(self._updates)
+        self._updates = []
+        self._updated_refs = set()
+        run(CmdArgs(["git", "update-ref", "--stdin", "-z"]), input=updates)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for p in (self._cat_file, self._cat_file_contents):
+                if p is not None:
+                    assert p.stdin is not None and p.stdout is not None
+                    p.stdin.close()
+                    p.wait()
+                    p.stdout.close()
+            self._cat_file = self._cat_file_contents = None
+
+
+GIT_BATCH = GitBatch()
 
 
 def run_always_return(cmd: CmdArgs, **kwargs) -> str:
@@ -238,43 +453,107 @@ def run(cmd: CmdArgs, **kwargs) -> Optional[str]:
     return None if out is None else out.strip()
 
 
+def _atomic_write_json(path: str, obj: JSON):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", buffering=1 << 20) as f:
+        json.dump(obj, f, separators=(",", ":"))
+    os.replace(tmp_path, path)  # make the write atomic
+
+
 def remove_prefix(s: str, prefix: str) -> str:
     if not s.startswith(prefix):
         die('Invalid string "{}": expected prefix "{}"', s, prefix)
     return s[len(prefix) :]  # noqa: E203
 
 
-def get_current_branch() -> Optional[BranchName]:
-    s = run(CmdArgs(["git", "symbolic-ref", "-q", "HEAD"]))
-    if s is not None:
-        return BranchName(remove_prefix(s, "refs/heads/"))
-    return None
-
-
-def get_all_branches() -> List[BranchName]:
-    branches = run_multiline(CmdArgs(["git", "for-each-ref", "--format", "%(refname:short)", "refs/heads"]))
-    assert branches is not None
-    return [BranchName(b) for b in branches.split("\n") if b]
+def get_current_branch() -> BranchName:
+    # git tells the top level and .git directories in the same go, remember them
+    global _TOP_LEVEL_DIR, _GIT_COMMON_DIR
+    top_level_dir, git_common_dir, head = run_lines(
+        CmdArgs(["git", "rev-parse", "--show-toplevel", "--git-common-dir", "--symbolic-full-name", "HEAD"])
+    )
+    _TOP_LEVEL_DIR = PathName(top_level_dir)
+    # Usually relative to the current directory
+    _GIT_COMMON_DIR = PathName(os.path.join(os.getcwd(), git_common_dir))
+    if not head.startswith("refs/heads/"):
+        die("HEAD is not a branch")
+    return BranchName(remove_prefix(head, "refs/heads/"))
 
 
 def get_real_stack_bottom() -> Optional[BranchName]:  # type: ignore [return]
     """
     return the actual stack bottom for this current repo
     """
-    branches = get_all_branches()
+    # Answered by the snapshot taken by load_all_stacks, no need to list the
+    # branches again
     candiates = set()
-    for b in branches:
-        if b in STACK_BOTTOMS:
+    for b in STACK_BOTTOMS:
+        if GIT_BATCH.resolve("refs/heads/{}".format(b)) is not None:
             candiates.add(b)
 
     if len(candiates) == 1:
         return candiates.pop()
 
 
+# branch name -> {variable: value} for all the branch.<name>.<variable> settings
+_BRANCH_CFG: Optional[Dict[BranchName, Dict[str, str]]] = None
+# remote.pushDefault, loaded along with the branch configuration
+_PUSH_DEFAULT: Optional[str] = None
+
+
+def _load_branch_config() -> Dict[BranchName, Dict[str, str]]:
+    """Read the configuration of all the branches, and remote.pushDefault,
+    with a single `git config`
+    """
+    global _BRANCH_CFG, _PUSH_DEFAULT
+    if _BRANCH_CFG is None:
+        # git config exits with 1 when nothing matches; it lowercases section
+        # and variable names, not branch names
+        lines = run_lines(
+            CmdArgs(["git", "config", "--get-regexp", r"^(branch\..*|remote\.pushdefault)$"]), check=False
+        )
+        cfg: Dict[BranchName, Dict[str, str]] = {}
+        _PUSH_DEFAULT = None
+        for line in lines:
+            key, _, value = line.partition(" ")
+            if key == "remote.pushdefault":
+                _PUSH_DEFAULT = value
+                continue
+            # Branch names can contain dots, the variable name can't
+            name, _, variable = remove_prefix(key, "branch.").rpartition(".")
+            cfg.setdefault(BranchName(name), {})[variable] = value
+        _BRANCH_CFG = cfg
+    return _BRANCH_CFG
+
+
+def _invalidate_branch_config():
+    global _BRANCH_CFG
+    _BRANCH_CFG = None
+    get_stack_parent_branch.cache_clear()
+
+
+def _invalidate_caches():
+    """Forget everything we know about refs and branch config, to be called
+    after running git commands that change them
+    """
+    _invalidate_branch_config()
+    GIT_BATCH.forget()
+
+
+def get_branch_config(branch: BranchName, variable: str) -> Optional[str]:
+    return _load_branch_config().get(branch, {}).get(variable)
+
+
+def get_push_default() -> Optional[str]:
+    _load_branch_config()
+    return _PUSH_DEFAULT
+
+
+@functools.lru_cache(maxsize=None)
 def get_stack_parent_branch(branch: BranchName) -> Optional[BranchName]:  # type: ignore [return]
     if branch in STACK_BOTTOMS:
         return None
-    p = run(CmdArgs(["git", "config", "branch.{}.merge".format(branch)]), check=False)
+    p = get_branch_config(branch, "merge")
     if p is not None:
         p = remove_prefix(p, "refs/heads/")
         if BranchName(p) == branch:
@@ -282,40 +561,175 @@ def get_stack_parent_branch(branch: BranchName) -> Optional[BranchName]:  # type
         return BranchName(p)
 
 
+_TOP_LEVEL_DIR: Optional[PathName] = None
+# Set by get_current_branch
+_GIT_COMMON_DIR: Optional[PathName] = None
+
+
 def get_top_level_dir() -> PathName:
-    p = run_always_return(CmdArgs(["git", "rev-parse", "--show-toplevel"]))
-    return PathName(p)
+    global _TOP_LEVEL_DIR
+    if _TOP_LEVEL_DIR is None:
+        _TOP_LEVEL_DIR = PathName(run_always_return(CmdArgs(["git", "rev-parse", "--show-toplevel"])))
+    return _TOP_LEVEL_DIR
 
 
-def get_stack_parent_commit(branch: BranchName) -> Optional[Commit]:  # type: ignore [return]
-    c = run(
-        CmdArgs(["git", "rev-parse", "refs/stack-parent/{}".format(branch)]),
-        check=False,
-    )
+def get_stack_parent_commit(branch: BranchName) -> Optional[Commit]:
+    return GIT_BATCH.resolve("refs/stack-parent/{}".format(branch))
+
+
+def get_commit(branch: BranchName) -> Commit:
+    c = GIT_BATCH.resolve("refs/heads/{}".format(branch))
+    assert c is not None
+    return c
+
+
+PR_INFO_FIELDS = [
+    "id",
+    "number",
+    "state",
+    "mergeable",
+    "url",
+    "title",
+    "baseRefName",
+    "headRefName",
+]
+# How many branches we query in a single GraphQL request, keeps the request
+# well under GitHub's node limit
+PR_QUERY_BRANCHES = 100
+# How many of those requests we make concurrently, only matters for forests
+# of more than PR_QUERY_BRANCHES branches
+PR_QUERY_JOBS = 4
+
+
+def make_pr_infos(branch: BranchName, raw_infos: List[PRInfo]) -> PRInfos:
+    infos: Dict[str, PRInfo] = {info["id"]: info for info in raw_infos}
+    open_prs: List[PRInfo] = [info for info in infos.values() if info["state"] == "OPEN"]
+    if len(open_prs) > 1:
+        die(
+            "Branch {} has more than one open PR: {}",
+            branch,
+            ", ".join([str(pr) for pr in open_prs]),
+        )  # type: ignore[arg-type]
+    return PRInfos(infos, open_prs[0] if open_prs else None)
+
+
+def get_pr_infos_for_branches(branches: List[BranchName], *, full: bool = False) -> Dict[BranchName, List[PRInfo]]:
+    # One aliased pullRequests(headRefName:) per branch, in as few GraphQL
+    # requests as possible; `gh pr list` JSON fields are the GraphQL ones
+    query = "b{}: pullRequests(headRefName: {}, first: 30, states: [OPEN, CLOSED, MERGED]) {{ nodes {{ {} }} }}"
+    fields = list(PR_INFO_FIELDS)
+    if full:
+        # Only the first commit, which is all `import` looks at
+        fields += ["commits(first: 1) { nodes { commit { oid } } }"]
+
+    def query_chunk(chunk: List[BranchName]) -> List[Tuple[BranchName, List[PRInfo]]]:
+        # JSON string escaping is valid GraphQL string escaping
+        queries = " ".join(query.format(i, json.dumps(b), " ".join(fields)) for i, b in enumerate(chunk))
+        data = json_loads(
+            run_always_return(
+                CmdArgs(
+                    [
+                        "gh",
+                        "api",
+                        "graphql",
+                        "-F",
+                        "owner={owner}",
+                        "-F",
+                        "repo={repo}",
+                        "-f",
+                        "query=query($owner: String!, $repo: String!) "
+                        "{{ repository(owner: $owner, name: $repo) {{ {} }} }}".format(queries),
+                    ]
+                )
+            )
+        )
+        repository = data["data"]["repository"]
+        results = [(b, repository["b{}".format(i)]["nodes"]) for i, b in enumerate(chunk)]
+        if full:
+            # Same shape as `gh pr list --json commits`
+            for _, infos in results:
+                for info in infos:
+                    info["commits"] = [node["commit"] for node in info["commits"]["nodes"]]
+        return results
+
+    chunks = [branches[i : i + PR_QUERY_BRANCHES] for i in range(0, len(branches), PR_QUERY_BRANCHES)]  # noqa: E203
+    if len(chunks) == 1:
+        return dict(query_chunk(chunks[0]))
+    # Each request is bound by network latency, run them concurrently
+    by_branch: Dict[BranchName, List[PRInfo]] = {}
+    with ThreadPoolExecutor(max_workers=min(len(chunks), PR_QUERY_JOBS)) as executor:
+        for results in executor.map(query_chunk, chunks):
+            by_branch.update(results)
+    return by_branch
+
+
+PRCacheEntry = Tuple[Commit, List[PRInfo], float]
+# repo -> branch -> [commit, raw PR infos, time], what `gh` said about the
+# branch at that time when its tip was at that commit. The file is shared by
+# all the repos, which can have the same branches (clones, forks)
+_PR_CACHE: Optional[Dict[str, Dict[BranchName, PRCacheEntry]]] = None
+_PR_CACHE_DIRTY = False
+
+
+def get_pr_cache() -> Dict[BranchName, PRCacheEntry]:
+    global _PR_CACHE
+    if _PR_CACHE is None:
+        try:
+            with open(PR_CACHE_FILE, "rb") as f:
+                _PR_CACHE = {
+                    repo: {BranchName(k): (Commit(v[0]), v[1], float(v[2])) for k, v in entries.items()}
+                    for repo, entries in json_loads(f.read()).items()
+                }
+        except (OSError, ValueError, TypeError, IndexError, AttributeError) as e:
+            debug("Not using PR cache: {}", e)
+            _PR_CACHE = {}
+        atexit.register(save_pr_cache)
+    # The .git directory tells repos apart, and is the same in all worktrees
+    assert _GIT_COMMON_DIR is not None
+    return _PR_CACHE.setdefault(os.path.realpath(_GIT_COMMON_DIR), {})
+
+
+def get_cached_pr_infos(branch: BranchName, commit: Commit) -> Optional[List[PRInfo]]:
+    entry = get_pr_cache().get(branch)
+    if entry is None or entry[0] != commit or time.time() - entry[2] >= PR_CACHE_LIFETIME:
+        return None
+    return entry[1]
+
 
-    if c is not None:
-        return Commit(c)
+def update_pr_cache(branch: BranchName, commit: Commit, raw_infos: List[PRInfo]):
+    global _PR_CACHE_DIRTY
+    get_pr_cache()[branch] = (commit, raw_infos, time.time())
+    _PR_CACHE_DIRTY = True
 
 
-def get_commit(branch: BranchName) -> Commit:  # type: ignore [return]
-    c = run_always_return(CmdArgs(["git", "rev-parse", "refs/heads/{}".format(branch)]), check=False)
-    return Commit(c)
+def forget_pr_cache(branch: BranchName):
+    global _PR_CACHE_DIRTY
+    if get_pr_cache().pop(branch, None) is not None:
+        _PR_CACHE_DIRTY = True
+
+
+def save_pr_cache():
+    if not _PR_CACHE_DIRTY or _PR_CACHE is None:
+        return
+    # Expired entries are never used again, don't let the file grow forever
+    now = time.time()
+    for repo, entries in list(_PR_CACHE.items()):
+        for branch, entry in list(entries.items()):
+            if now - entry[2] >= PR_CACHE_LIFETIME:
+                del entries[branch]
+        if not entries:
+            del _PR_CACHE[repo]
+    try:
+        _atomic_write_json(PR_CACHE_FILE, _PR_CACHE)
+    except OSError as e:
+        debug("Failed to save PR cache: {}", e)
 
 
 def get_pr_info(branch: BranchName, *, full: bool = False) -> PRInfos:
-    fields = [
-        "id",
-        "number",
-        "state",
-        "mergeable",
-        "url",
-        "title",
-        "baseRefName",
-        "headRefName",
-    ]
+    fields = list(PR_INFO_FIELDS)
     if full:
         fields += ["commits"]
-    data = json.loads(
+    data = json_loads(
         run_always_return(
             CmdArgs(
                 [
@@ -333,22 +747,13 @@ def get_pr_info(branch: BranchName, *, full: bool = False) -> PRInfos:
         )
     )
     raw_infos: List[PRInfo] = data
-
-    infos: Dict[str, PRInfo] = {info["id"]: info for info in raw_infos}
-    open_prs: List[PRInfo] = [info for info in infos.values() if info["state"] == "OPEN"]
-    if len(open_prs) > 1:
-        die(
-            "Branch {} has more than one open PR: {}",
-            branch,
-            ", ".join([str(pr) for pr in open_prs]),
-        )  # type: ignore[arg-type]
-    return PRInfos(infos, open_prs[0] if open_prs else None)
+    return make_pr_infos(branch, raw_infos)
 
 
 # (remote, remote_branch, remote_branch_commit)
 def get_remote_info(branch: BranchName) -> Tuple[str, BranchName, Optional[Commit]]:
     if branch not in STACK_BOTTOMS:
-        remote = run(CmdArgs(["git", "config", "branch.{}.remote".format(branch)]), check=False)
+        remote = get_branch_config(branch, "remote")
         if remote != ".":
             die("Misconfigured branch {}: remote {}", branch, remote)
 
@@ -356,15 +761,8 @@ def get_remote_info(branch: BranchName) -> Tuple[str, BranchName, Optional[Commi
     remote = "origin"
     remote_branch = branch
 
-    remote_commit = run(
-        CmdArgs(["git", "rev-parse", "refs/remotes/{}/{}".format(remote, remote_branch)]),
-        check=False,
-    )
-
     # TODO(mpatou): do something when remote_commit is none
-    commit = None
-    if remote_commit is not None:
-        commit = Commit(remote_commit)
+    commit = GIT_BATCH.resolve("refs/remotes/{}/{}".format(remote, remote_branch))
 
     return (remote, BranchName(remote_branch), commit)
 
@@ -379,12 +777,15 @@ class StackBranch:
         self.name = name
         self.parent = parent
         self.parent_commit = parent_commit
-        self.children: set["StackBranch"] = set()
+        # Sorted by name, which is the order we display them in
+        self.children: List["StackBranch"] = []
         self.commit = get_commit(name)
         self.remote, self.remote_branch, self.remote_commit = get_remote_info(name)
         self.pr_info: Dict[str, PRInfo] = {}
         self.open_pr_info: Optional[PRInfo] = None
         self._pr_info_loaded = False
+        # Equal to _SYNC_EPOCH when the current do_sync is going to sync it
+        self._sync_epoch = 0
 
     def is_synced_with_parent(self):
         return self.parent is None or self.parent_commit == self.parent.commit
@@ -395,10 +796,11 @@ class StackBranch:
     def __repr__(self):
         return f"StackBranch: {self.name} {len(self.children)} {self.commit}"
 
-    def load_pr_info(self):
+    def load_pr_info(self, pr_infos: Optional[PRInfos] = None):
         if not self._pr_info_loaded:
             self._pr_info_loaded = True
-            pr_infos = get_pr_info(self.name)
+            if pr_infos is None:
+                pr_infos = get_pr_info(self.name)
             # FIXME maybe store the whole object and use it elsewhere
             self.pr_info, self.open_pr_info = (
                 pr_infos.all,
@@ -461,7 +863,8 @@ class StackBranchSet:
         return out
 
     def add_child(self, s: StackBranch, child: StackBranch):
-        s.children.add(child)
+        if child not in s.children:
+            s.children.insert(bisect.bisect([c.name for c in s.children], child.name), child)
         self.tops.discard(s)
 
 
@@ -472,9 +875,11 @@ def load_stack_for_given_branch(
     update the stack with all the parents of the specified branch
     if the branch is part of an existing stack.
     Return also a list of BranchName of all the branch bellow the specified one
+    The walk stops at the first branch already in the stack, its ancestors
+    have been loaded along with it
     """
     branches: List[BranchNCommit] = []
-    while branch not in STACK_BOTTOMS:
+    while branch not in STACK_BOTTOMS and branch not in stack.stack:
         parent = get_stack_parent_branch(branch)
         parent_commit = get_stack_parent_commit(branch)
         branches.append(BranchNCommit(branch, parent_commit))
@@ -484,8 +889,9 @@ def load_stack_for_given_branch(
             return None, [b.branch for b in branches]
         branch = parent
 
-    branches.append(BranchNCommit(branch, None))
-    top = None
+    top = stack.stack.get(branch)
+    if top is None:
+        branches.append(BranchNCommit(branch, None))
     for b in reversed(branches):
         n = stack.add(
             b.branch,
@@ -499,41 +905,40 @@ def load_stack_for_given_branch(
     return top, [b.branch for b in branches]
 
 
-def get_branch_name_from_short_ref(ref: str) -> BranchName:
-    parts = ref.split("/", 1)
-    if len(parts) != 2:
-        die("invalid ref: {}".format(ref))
-
-    return BranchName(parts[1])
-
-
-def get_all_stack_bottoms() -> List[BranchName]:
-    branches = run_multiline(
-        CmdArgs(["git", "for-each-ref", "--format", "%(refname:short)", "refs/stacky-bottom-branch"])
-    )
-    if branches:
-        return [get_branch_name_from_short_ref(b) for b in branches.split("\n") if b]
-    return []
-
-
-def get_all_stack_parent_refs() -> List[BranchName]:
-    branches = run_multiline(CmdArgs(["git", "for-each-ref", "--format", "%(refname:short)", "refs/stack-parent"]))
-    if branches:
-        return [get_branch_name_from_short_ref(b) for b in branches.split("\n") if b]
-    return []
-
-
-def load_all_stack_bottoms():
-    branches = run_multiline(
-        CmdArgs(["git", "for-each-ref", "--format", "%(refname:short)", "refs/stacky-bottom-branch"])
+def load_all_refs() -> Tuple[List[BranchName], List[BranchName], RefsSnapshot]:
+    """Return (branches, stack bottoms, snapshot of the branch, stack parent
+    and origin refs) using a single `git for-each-ref`
+    """
+    prefixes = ["refs/heads/", "refs/stacky-bottom-branch/", "refs/stack-parent/", "refs/remotes/origin/"]
+    out = run_lines(
+        CmdArgs(["git", "for-each-ref", "--format", "%(objectname) %(refname)"] + [p[:-1] for p in prefixes])
     )
-    STACK_BOTTOMS.update(get_all_stack_bottoms())
+    names: Dict[str, List[BranchName]] = {p: [] for p in prefixes}
+    snapshot: RefsSnapshot = {}
+    for line in out:
+        commit, _, ref = line.partition(" ")
+        snapshot[ref] = Commit(commit)
+        for prefix in prefixes:
+            if ref.startswith(prefix):
+                names[prefix].append(BranchName(ref[len(prefix) :]))  # noqa: E203
+                break
+    return names["refs/heads/"], names["refs/stacky-bottom-branch/"], snapshot
 
 
 def load_all_stacks(stack: StackBranchSet) -> Optional[StackBranch]:
     """Given a stack return the top of it, aka the bottom of the tree"""
-    load_all_stack_bottoms()
-    all_branches = set(get_all_branches())
+    global STACK_BOTTOMS
+    heads, bottoms, refs = load_all_refs()
+    STACK_BOTTOMS = FROZEN_STACK_BOTTOMS.union(bottoms)
+    all_branches = set(heads)
+    # The snapshot is complete, refs it doesn't list don't exist: record that
+    # so that nobody goes asking git about them again
+    for b in all_branches:
+        refs.setdefault("refs/stack-parent/{}".format(b), None)
+        refs.setdefault("refs/remotes/origin/{}".format(b), None)
+    for b in STACK_BOTTOMS:
+        refs.setdefault("refs/heads/{}".format(b), None)
+    GIT_BATCH.remember(refs)
     current_branch_top = None
     while all_branches:
         b = all_branches.pop()
@@ -554,7 +959,7 @@ def make_tree_node(b: StackBranch) -> TreeNode:
 
 
 def make_subtree(b) -> BranchesTree:
-    return BranchesTree(dict(make_tree_node(c) for c in sorted(b.children, key=lambda x: x.name)))
+    return BranchesTree(dict(make_tree_node(c) for c in b.children))
 
 
 def make_tree(b: StackBranch) -> BranchesTree:
@@ -562,6 +967,15 @@ def make_tree(b: StackBranch) -> BranchesTree:
 
 
 def format_name(b: StackBranch, *, colorize: bool) -> str:
+    if (
+        not colorize
+        and not b.open_pr_info
+        and b.name != CURRENT_BRANCH
+        and b.is_synced_with_parent()
+        and b.is_synced_with_remote()
+    ):
+        # Nothing to decorate
+        return b.name
     prefix = ""
     severity = 0
     # TODO: Align things so that we have the same prefix length ?
@@ -586,36 +1000,44 @@ def format_name(b: StackBranch, *, colorize: bool) -> str:
     return prefix + fmt("{}", b.name, color=colorize, fg=fg) + suffix
 
 
-def format_tree(tree: BranchesTree, *, colorize: bool = False):
-    return {
-        format_name(branch, colorize=colorize): format_tree(children, colorize=colorize)
-        for branch, children in tree.values()
-    }
-
-
-# Print upside down, to match our "upstack" / "downstack" nomenclature
+# Printed upside down, to match our "upstack" / "downstack" nomenclature, so
+# the last child is drawn with an "up and right" corner
 _ASCII_TREE_BOX = {
     "UP_AND_RIGHT": "\u250c",
     "HORIZONTAL": "\u2500",
     "VERTICAL": "\u2502",
     "VERTICAL_AND_RIGHT": "\u251c",
 }
-_ASCII_TREE_STYLE = asciitree.drawing.BoxStyle(gfx=_ASCII_TREE_BOX)
-ASCII_TREE = asciitree.LeftAligned(draw=_ASCII_TREE_STYLE)
+_CHILD_HEAD = " " + _ASCII_TREE_BOX["VERTICAL_AND_RIGHT"] + _ASCII_TREE_BOX["HORIZONTAL"] * 2 + " "
+_CHILD_TAIL = " " + _ASCII_TREE_BOX["VERTICAL"] + "  "
+_LAST_CHILD_HEAD = " " + _ASCII_TREE_BOX["UP_AND_RIGHT"] + _ASCII_TREE_BOX["HORIZONTAL"] * 2 + " "
+_LAST_CHILD_TAIL = "    "
 
 
-def print_tree(tree: BranchesTree):
-    global ASCII_TREE
-    s = ASCII_TREE(format_tree(tree, colorize=COLOR_STDOUT))
-    lines = s.split("\n")
-    print("\n".join(reversed(lines)))
+def render_tree(tree: BranchesTree, *, colorize: bool = False) -> List[str]:
+    """Render the tree as lines, top down, parents before their children"""
+    lines: List[str] = []
+    # (subtree, prefix of its line, prefix of its descendants' lines)
+    todo: List[Tuple[StackSubTree, str, str]] = [(node, "", "") for node in reversed(list(tree.values()))]
+    while todo:
+        (branch, children), head, tail = todo.pop()
+        lines.append(head + format_name(branch, colorize=colorize))
+        nodes = list(children.values())
+        if nodes:
+            todo.append((nodes[-1], tail + _LAST_CHILD_HEAD, tail + _LAST_CHILD_TAIL))
+            for node in reversed(nodes[:-1]):
+                todo.append((node, tail + _CHILD_HEAD, tail + _CHILD_TAIL))
+    return lines
+
+
+def format_tree(tree: BranchesTree) -> str:
+    return "\n".join(reversed(render_tree(tree, colorize=COLOR_STDOUT)))
 
 
 def print_forest(trees: List[BranchesTree]):
-    for i, t in enumerate(trees):
-        if i != 0:
-            print()
-        print_tree(t)
+    # A single write for the whole forest, trees separated by a blank line
+    if trees:
+        print("\n\n".join(format_tree(t) for t in trees))
 
 
 def get_all_stacks_as_forest(stack: StackBranchSet) -> BranchesTreeForest:
@@ -646,13 +1068,33 @@ def get_current_downstack_as_forest(stack: StackBranchSet) -> BranchesTreeForest
     return BranchesTreeForest([d])
 
 
-def init_git():
-    push_default = run(["git", "config", "remote.pushDefault"], check=False)
-    if push_default is not None:
-        die("`git config remote.pushDefault` may not be set")
-    auth_status = run(["gh", "auth", "status"], check=False)
+def check_gh_auth():
+    try:
+        if time.time() - os.path.getmtime(AUTH_CACHE_FILE) < AUTH_CACHE_LIFETIME:
+            return
+    except OSError:
+        pass
+    auth_status = run(CmdArgs(["gh", "auth", "status"]), check=False)
     if auth_status is None:
         die("`gh` authentication failed")
+    try:
+        with open(AUTH_CACHE_FILE, "w"):
+            pass
+    except OSError as e:
+        debug("Failed to save auth cache: {}", e)
+
+
+def forget_gh_auth():
+    try:
+        os.remove(AUTH_CACHE_FILE)
+    except OSError:
+        pass
+
+
+def init_git():
+    if get_push_default() is not None:
+        die("`git config remote.pushDefault` may not be set")
+    check_gh_auth()
     global CURRENT_BRANCH
     CURRENT_BRANCH = get_current_branch()
 
@@ -666,23 +1108,25 @@ def forest_depth_first(
 
 
 def depth_first(tree: BranchesTree) -> Generator[StackBranch, None, None]:
-    # This is for the regular forest
-    for _, (branch, children) in tree.items():
+    # This is for the regular forest, parents come before their children
+    todo = list(reversed(tree.values()))
+    while todo:
+        branch, children = todo.pop()
         yield branch
-        for b in depth_first(children):
-            yield b
+        todo.extend(reversed(children.values()))
 
 
 def menu_choose_branch(forest: BranchesTreeForest):
     if not IS_TERMINAL:
         die("May only choose from menu when using a terminal")
+    try:
+        from simple_term_menu import TerminalMenu  # type: ignore
+    except ImportError:
+        die("Choosing from a menu requires simple-term-menu, install rockset-stacky[tui]")
 
-    global ASCII_TREE
-    s = ""
     lines = []
     for tree in forest:
-        s = ASCII_TREE(format_tree(tree))
-        lines += [l.rstrip() for l in s.split("\n")]
+        lines += [l.rstrip() for l in render_tree(tree)]
     lines.reverse()
 
     initial_index = 0
@@ -701,15 +1145,38 @@ def menu_choose_branch(forest: BranchesTreeForest):
     return branches[idx]
 
 
-def load_pr_info_for_forest(forest: BranchesTreeForest):
-    for b in forest_depth_first(forest):
-        b.load_pr_info()
+def load_pr_info_for_forest(forest: BranchesTreeForest, *, use_cache: bool = False):
+    # The cache is mostly good for display: it can't tell that a PR got merged
+    # or opened elsewhere while the branch stayed at the same commit, so
+    # commands acting on PRs ask `gh` (and refresh the cache). The exception
+    # is cmd_land trusting a cached MERGEABLE PR: the merge it then runs with
+    # --match-head-commit fails on GitHub's side if the PR no longer is
+    # mergeable or its head moved, so it can't merge anything stale
+    branches = [b for b in forest_depth_first(forest) if not b._pr_info_loaded]
+    if use_cache and PR_CACHE_ENABLED:
+        missing = []
+        for b in branches:
+            raw_infos = get_cached_pr_infos(b.name, b.commit)
+            if raw_infos is not None:
+                b.load_pr_info(make_pr_infos(b.name, raw_infos))
+            else:
+                missing.append(b)
+        branches = missing
+    if not branches:
+        return
+    # Only ask about our branches, however many PRs the repo has
+    all_pr_infos = get_pr_infos_for_branches([b.name for b in branches])
+    for b in branches:
+        b.load_pr_info(make_pr_infos(b.name, all_pr_infos.get(b.name, [])))
+    if PR_CACHE_ENABLED:
+        for b in branches:
+            update_pr_cache(b.name, b.commit, list(b.pr_info.values()))
 
 
 def cmd_info(stack: StackBranchSet, args):
     forest = get_all_stacks_as_forest(stack)
     if args.pr:
-        load_pr_info_for_forest(forest)
+        load_pr_info_for_forest(forest, use_cache=True)
     print_forest(forest)
 
 
@@ -753,6 +1220,7 @@ def cmd_branch_down(stack: StackBranchSet, args):
 
 def create_branch(branch):
     run(["git", "checkout", "-b", branch, "--track"], out=True)
+    _invalidate_caches()
 
 
 def cmd_branch_new(stack: StackBranchSet, args):
@@ -760,7 +1228,7 @@ def cmd_branch_new(stack: StackBranchSet, args):
     assert b.commit
     name = args.name
     create_branch(name)
-    run(CmdArgs(["git", "update-ref", "refs/stack-parent/{}".format(name), b.commit, ""]))
+    GIT_BATCH.update_ref("refs/stack-parent/{}".format(name), b.commit, "")
 
 
 def cmd_branch_checkout(stack: StackBranchSet, args):
@@ -774,7 +1242,7 @@ def cmd_branch_checkout(stack: StackBranchSet, args):
 def cmd_stack_info(stack: StackBranchSet, args):
     forest = get_current_stack_as_forest(stack)
     if args.pr:
-        load_pr_info_for_forest(forest)
+        load_pr_info_for_forest(forest, use_cache=True)
     print_forest(forest)
 
 
@@ -816,21 +1284,21 @@ def confirm(msg: str = "Proceed?"):
         cout("Please answer yes or no\n", fg="red")
 
 
+_REVIEWER_RE = re.compile(r"^reviewers?\s*:\s*(.*)", re.I)
+_ISSUE_RE = re.compile(r"(?:^|[_-])([A-Z]{3,}[_-]?\d{2,})($|[_-].*)")
+_ISSUE_SPLIT_RE = re.compile(r"(...)(\d+)")
+
+
+def get_commit_subject_and_body(commit: Commit) -> Tuple[str, str]:
+    # Same as git's %s and %b: the subject is the first paragraph
+    subject, _, body = GIT_BATCH.commit_message(commit).lstrip("\n").partition("\n\n")
+    return " ".join(subject.split("\n")).strip(), body
+
+
 def find_reviewers(b: StackBranch) -> Optional[List[str]]:
-    out = run_multiline(
-        CmdArgs(
-            [
-                "git",
-                "log",
-                "--pretty=format:%b",
-                "-1",
-                f"{b.name}",
-            ]
-        ),
-    )
-    assert out is not None
-    for l in out.split("\n"):
-        reviewer_match = re.match(r"^reviewers?\s*:\s*(.*)", l, re.I)
+    _, body = get_commit_subject_and_body(b.commit)
+    for l in body.splitlines():
+        reviewer_match = _REVIEWER_RE.match(l)
         if reviewer_match:
             reviewers = reviewer_match.group(1).split(",")
             logging.debug(f"Found the following reviewers: {', '.join(reviewers)}")
@@ -839,13 +1307,13 @@ def find_reviewers(b: StackBranch) -> Optional[List[str]]:
 
 
 def find_issue_marker(name: str) -> Optional[str]:
-    match = re.search(r"(?:^|[_-])([A-Z]{3,}[_-]?\d{2,})($|[_-].*)", name)
+    match = _ISSUE_RE.search(name)
     if match:
         res = match.group(1)
         if "_" in res:
             return res.replace("_", "-")
         if not "-" in res:
-            newmatch = re.match(r"(...)(\d+)", res)
+            newmatch = _ISSUE_SPLIT_RE.match(res)
             assert newmatch is not None
             return f"{newmatch.group(1)}-{newmatch.group(2)}"
         return res
@@ -872,28 +1340,13 @@ def create_gh_pr(b: StackBranch, prefix: str):
     reviewers = find_reviewers(b)
     issue_id = find_issue_marker(b.name)
     if issue_id:
-        out = run_multiline(
-            CmdArgs(["git", "log", "--pretty=oneline", f"{b.parent.name}..{b.name}"]),
-        )
+        # We only need to know if there is exactly one commit, listing two
+        # is enough however long the branch is
+        commits = run_lines(CmdArgs(["git", "rev-list", "--max-count=2", f"{b.parent.name}..{b.name}"]))
         title = f"[{issue_id}] "
-        # Just one line (hence 2 elements with the last one being an empty string when we
-        # split on "\"n ?
-        # Then use the title of the commit as the title of the PR
-        if out is not None and len(out.split("\n")) == 2:
-            out = run(
-                CmdArgs(
-                    [
-                        "git",
-                        "log",
-                        "--pretty=format:%s",
-                        "-1",
-                        f"{b.name}",
-                    ]
-                ),
-                out=False,
-            )
-            if out is None:
-                out = ""
+        # Just one commit ? Then use the title of the commit as the title of the PR
+        if len(commits) == 1:
+            out, _ = get_commit_subject_and_body(Commit(commits[0]))
             if b.name not in out:
                 title += out
             else:
@@ -918,6 +1371,21 @@ def create_gh_pr(b: StackBranch, prefix: str):
     )
 
 
+def fix_pr_bases(branches: List[StackBranch]):
+    # A single GraphQL request with one aliased mutation per PR, rather than
+    # one `gh pr edit` per PR
+    mutation = "fix{}: updatePullRequest(input: {{pullRequestId: {}, baseRefName: {}}}) {{ pullRequest {{ number }} }}"
+    mutations = []
+    for i, b in enumerate(branches):
+        cout("Fixing PR base for {}\n", b.name, fg="green")
+        assert b.open_pr_info is not None
+        # JSON string escaping is valid GraphQL string escaping
+        mutations.append(mutation.format(i, json.dumps(b.open_pr_info["id"]), json.dumps(b.parent.name)))
+    run(CmdArgs(["gh", "api", "graphql", "-f", "query=mutation {{ {} }}".format(" ".join(mutations))]))
+    for b in branches:
+        forget_pr_cache(b.name)
+
+
 def do_push(
     forest: BranchesTreeForest,
     *,
@@ -928,20 +1396,24 @@ def do_push(
     if pr:
         load_pr_info_for_forest(forest)
     print_forest(forest)
-    for b in forest_depth_first(forest):
-        if not b.is_synced_with_parent():
-            die(
-                "Branch {} is not synced with parent {}, sync first",
-                b.name,
-                b.parent.name,
-            )
+    # Walk the forest once, both passes below use the same order
+    forest_branches = list(forest_depth_first(forest))
+    # Report all the unsynced branches at once, before announcing any plan
+    unsynced = [b for b in forest_branches if not b.is_synced_with_parent()]
+    if len(unsynced) == 1:
+        die("Branch {} is not synced with parent {}, sync first", unsynced[0].name, unsynced[0].parent.name)
+    elif unsynced:
+        die(
+            "Branches are not synced with their parent, sync first: {}",
+            ", ".join("{} (parent {})".format(b.name, b.parent.name) for b in unsynced),
+        )
 
     # (branch, push, pr_action)
     PR_NONE = 0
     PR_FIX_BASE = 1
     PR_CREATE = 2
     actions = []
-    for b in forest_depth_first(forest):
+    for b in forest_branches:
         if not b.parent:
             cout("✓ Not pushing base branch {}\n", b.name, fg="green")
             continue
@@ -999,50 +1471,41 @@ def do_push(
         # If there is a "/" in the gh-resolved it means that the repo where
         # the should be created is not the same as the one where the push will
         # be made, we need to add a prefix to the branch in the gh pr command
-        val = run_always_return(CmdArgs(["git", "config", f"remote.{remote_name}.url"]))
+        val = get_remote_url(remote_name)
         prefix = f'{val.split(":")[1].split("/")[0]}:'
     else:
         prefix = ""
-    muxed = False
-    for b, push, pr_action in actions:
+    # One push per remote for all the branches that need it, before touching
+    # PRs so that the PR base branches exist on the remote
+    pushes: Dict[str, List[StackBranch]] = {}
+    for b, push, _ in actions:
         if push:
-            if not muxed:
-                start_muxed_ssh(remote_name)
-                muxed = True
-            # Try to run pre-push before muxing ...
-            # To do so we need to pickup the current commit of the branch, the branch name, the
-            # parent branch and it's parent commit and call .git/hooks/pre-push
+            pushes.setdefault(b.remote, []).append(b)
+    if pushes:
+        start_muxed_ssh(remote_name)
+    for remote, branches in pushes.items():
+        # Try to run pre-push before muxing ...
+        # To do so we need to pickup the current commit of the branch, the branch name, the
+        # parent branch and it's parent commit and call .git/hooks/pre-push
+        for b in branches:
             cout("Pushing {}\n", b.name, fg="green")
-            run(
-                CmdArgs(
-                    [
-                        "git",
-                        "push",
-                        "-f" if get_config().use_force_push else "",
-                        b.remote,
-                        "{}:{}".format(b.name, b.remote_branch),
-                    ]
-                ),
-                out=True,
-            )
-        if pr_action == PR_FIX_BASE:
-            cout("Fixing PR base for {}\n", b.name, fg="green")
-            assert b.open_pr_info is not None
-            run(
-                CmdArgs(
-                    [
-                        "gh",
-                        "pr",
-                        "edit",
-                        str(b.open_pr_info["number"]),
-                        "--base",
-                        b.parent.name,
-                    ]
-                ),
-                out=True,
-            )
-        elif pr_action == PR_CREATE:
+        cmd = ["git", "push"]
+        if get_config().use_force_push:
+            cmd.append("-f")
+        cmd.append(remote)
+        cmd.extend("{}:{}".format(b.name, b.remote_branch) for b in branches)
+        run(CmdArgs(cmd), out=True)
+    if pushes:
+        # The push moved the remote-tracking refs
+        _invalidate_caches()
+
+    fix_bases = [b for b, _, pr_action in actions if pr_action == PR_FIX_BASE]
+    if fix_bases:
+        fix_pr_bases(fix_bases)
+    for b, _, pr_action in actions:
+        if pr_action == PR_CREATE:
             create_gh_pr(b, prefix)
+            forget_pr_cache(b.name)
 
     stop_muxed_ssh(remote_name)
 
@@ -1057,16 +1520,17 @@ def cmd_stack_push(stack: StackBranchSet, args):
 
 
 def do_sync(forest: BranchesTreeForest):
+    global _SYNC_EPOCH
     print_forest(forest)
 
+    _SYNC_EPOCH += 1
     syncs: List[StackBranch] = []
     sync_names: List[BranchName] = []
-    syncs_set: set[StackBranch] = set()
     for b in forest_depth_first(forest):
         if not b.parent:
             cout("✓ Not syncing base branch {}\n", b.name, fg="green")
             continue
-        if b.is_synced_with_parent() and not b.parent in syncs_set:
+        if b.is_synced_with_parent() and b.parent._sync_epoch != _SYNC_EPOCH:
             cout(
                 "✓ Not syncing branch {}, already synced with parent {}\n",
                 b.name,
@@ -1075,86 +1539,99 @@ def do_sync(forest: BranchesTreeForest):
             )
             continue
         syncs.append(b)
-        syncs_set.add(b)
+        b._sync_epoch = _SYNC_EPOCH
         sync_names.append(b.name)
         cout("- Will sync branch {} on top of {}\n", b.name, b.parent.name)
 
     if not syncs:
         return
 
-    syncs.reverse()
-    sync_names.reverse()
-    # TODO: use list(syncs_set).reverse() ?
     inner_do_sync(syncs, sync_names)
 
 
 def set_parent_commit(branch: BranchName, new_commit: Commit, prev_commit: Optional[str] = None):
-    cmd = [
-        "git",
-        "update-ref",
-        "refs/stack-parent/{}".format(branch),
-        new_commit,
-    ]
-    if prev_commit is not None:
-        cmd.append(prev_commit)
-    run(CmdArgs(cmd))
+    GIT_BATCH.update_ref("refs/stack-parent/{}".format(branch), new_commit, prev_commit)
 
 
-def get_commits_between(a: Commit, b: Commit):
-    lines = run_multiline(CmdArgs(["git", "rev-list", "{}..{}".format(a, b)]))
-    assert lines is not None
-    return [x.strip() for x in lines.split("\n")]
+# Commits are immutable, so is their ancestry
+@functools.lru_cache(maxsize=4096)
+def is_ancestor(a: Commit, b: Commit) -> bool:
+    cmd = CmdArgs(["git", "merge-base", "--is-ancestor", a, b])
+    debug_command(cmd)
+    sp = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding="UTF-8", errors="replace")
+    # 1 means "not an ancestor", anything else is an actual error
+    if sp.returncode != 1:
+        _check_returncode(sp, cmd)
+    return sp.returncode == 0
 
 
 def inner_do_sync(syncs: List[StackBranch], sync_names: List[BranchName]):
+    """Sync the branches in order, parents before their children"""
     print()
     sync_type = "merge" if get_config().use_merge else "rebase"
-    while syncs:
-        with open(TMP_STATE_FILE, "w") as f:
-            json.dump({"branch": CURRENT_BRANCH, "sync": sync_names}, f)
-        os.replace(TMP_STATE_FILE, STATE_FILE)  # make the write atomic
-
-        b = syncs.pop()
-        sync_names.pop()
-        if b.is_synced_with_parent():
-            cout("{} is already synced on top of {}\n", b.name, b.parent.name)
-            continue
-        if b.parent.commit in get_commits_between(b.parent_commit, b.commit):
-            cout(
-                "Recording complete {} of {} on top of {}\n",
-                sync_type,
-                b.name,
-                b.parent.name,
-                fg="green",
-            )
-        else:
-            r = None
-            if get_config().use_merge:
-                cout("Merging {} into {}\n", b.parent.name, b.name, fg="green")
-                run(CmdArgs(["git", "checkout", str(b.name)]))
-                r = run(
-                    CmdArgs(["git", "merge", b.parent.name]),
-                    out=True,
-                    check=False,
+    # The new parent commits are recorded all at once at the end, with a
+    # single update-ref, even when a rebase fails half way through
+    parent_commits: List[Tuple[BranchName, Commit, Commit]] = []
+
+    def save_state(i: int):
+        # What's left for `stacky continue` to finish: this branch and the
+        # ones after it
+        _atomic_write_json(STATE_FILE, dataclasses.asdict(SyncState(CURRENT_BRANCH, sync_names[i:])))
+
+    try:
+        for i, b in enumerate(syncs):
+            if b.is_synced_with_parent():
+                cout("{} is already synced on top of {}\n", b.name, b.parent.name)
+                continue
+            # The parent's new tip is in parent_commit..commit: somebody already
+            # did the rebase (ie. `git rebase --continue` before `stacky continue`)
+            if is_ancestor(b.parent.commit, b.commit) and not is_ancestor(b.parent.commit, b.parent_commit):
+                cout(
+                    "Recording complete {} of {} on top of {}\n",
+                    sync_type,
+                    b.name,
+                    b.parent.name,
+                    fg="green",
                 )
             else:
-                cout("Rebasing {} on top of {}\n", b.name, b.parent.name, fg="green")
-                r = run(
-                    CmdArgs(["git", "rebase", "--onto", b.parent.name, b.parent_commit, b.name]),
-                    out=True,
-                    check=False,
-                )
+                r = None
+                if get_config().use_merge:
+                    cout("Merging {} into {}\n", b.parent.name, b.name, fg="green")
+                    try:
+                        run(CmdArgs(["git", "checkout", str(b.name)]))
+                    except ExitException as e:
+                        # Like a failed merge, `stacky continue` starts over
+                        # from this branch
+                        save_state(i)
+                        die("{}\nPlease fix that, then run `stacky continue`", e.args[0])
+                    r = run(
+                        CmdArgs(["git", "merge", b.parent.name]),
+                        out=True,
+                        check=False,
+                    )
+                else:
+                    cout("Rebasing {} on top of {}\n", b.name, b.parent.name, fg="green")
+                    r = run(
+                        CmdArgs(["git", "rebase", "--onto", b.parent.name, b.parent_commit, b.name]),
+                        out=True,
+                        check=False,
+                    )
 
-            if r is None:
-                print()
-                die(
-                    "Automatic {0} failed. Please complete the {0} (fix conflicts; `git {0} --continue`), then run `stacky continue`".format(
-                        sync_type
+                if r is None:
+                    save_state(i)
+                    print()
+                    die(
+                        "Automatic {0} failed. Please complete the {0} (fix conflicts; `git {0} --continue`), then run `stacky continue`".format(
+                            sync_type
+                        )
                     )
-                )
-            b.commit = get_commit(b.name)
-        set_parent_commit(b.name, b.parent.commit, b.parent_commit)
-        b.parent_commit = b.parent.commit
+                _invalidate_caches()
+                b.commit = get_commit(b.name)
+            parent_commits.append((b.name, b.parent.commit, b.parent_commit))
+            b.parent_commit = b.parent.commit
+    finally:
+        for name, new_commit, prev_commit in parent_commits:
+            set_parent_commit(name, new_commit, prev_commit)
     run(CmdArgs(["git", "checkout", str(CURRENT_BRANCH)]))
 
 
@@ -1191,6 +1668,7 @@ def do_commit(stack: StackBranchSet, *, message=None, amend=False, allow_empty=F
     if message:
         cmd += ["-m", message]
     run(CmdArgs(cmd), out=True)
+    _invalidate_caches()
 
     # Sync everything upstack
     b.commit = get_commit(b.name)
@@ -1214,7 +1692,7 @@ def cmd_amend(stack: StackBranchSet, args):
 def cmd_upstack_info(stack: StackBranchSet, args):
     forest = get_current_upstack_as_forest(stack)
     if args.pr:
-        load_pr_info_for_forest(forest)
+        load_pr_info_for_forest(forest, use_cache=True)
     print_forest(forest)
 
 
@@ -1248,16 +1726,8 @@ def set_parent(branch: BranchName, target: Optional[BranchName], *, set_origin:
     )
 
     if target is None:
-        run(
-            CmdArgs(
-                [
-                    "git",
-                    "update-ref",
-                    "-d",
-                    "refs/stack-parent/{}".format(branch),
-                ]
-            )
-        )
+        GIT_BATCH.delete_ref("refs/stack-parent/{}".format(branch))
+    _invalidate_branch_config()
 
 
 def cmd_upstack_onto(stack: StackBranchSet, args):
@@ -1265,14 +1735,23 @@ def cmd_upstack_onto(stack: StackBranchSet, args):
     if not b.parent:
         die("may not upstack a stack bottom, use stacky adopt")
     target = stack.stack[args.target]
-    upstack = get_current_upstack_as_forest(stack)
-    for ub in forest_depth_first(upstack):
-        if ub == target:
+    # The target is upstack of b iff b is one of its ancestors, which is
+    # cheaper to walk than the whole upstack
+    ancestor: Optional[StackBranch] = target
+    while ancestor is not None:
+        if ancestor is b:
             die("Target branch {} is upstack of {}", target.name, b.name)
+        ancestor = ancestor.parent
+    # Move b in the loaded stack too, rather than reloading anything: the
+    # upstack forest is built from it and do_sync relies on b.parent
+    b.parent.children.remove(b)
+    if not b.parent.children:
+        stack.tops.add(b.parent)
     b.parent = target
+    stack.add_child(target, b)
     set_parent(b.name, target.name)
 
-    do_sync(upstack)
+    do_sync(get_current_upstack_as_forest(stack))
 
 
 def cmd_upstack_as_base(stack: StackBranchSet):
@@ -1285,7 +1764,7 @@ def cmd_upstack_as_base(stack: StackBranchSet):
     stack.addStackBranch(b)
     set_parent(b.name, None)
 
-    run(CmdArgs(["git", "update-ref", "refs/stacky-bottom-branch/{}".format(b.name), b.commit, ""]))
+    GIT_BATCH.update_ref("refs/stacky-bottom-branch/{}".format(b.name), b.commit, "")
     info("Set {} as new bottom branch".format(b.name))
 
 
@@ -1299,7 +1778,7 @@ def cmd_upstack_as(stack: StackBranchSet, args):
 def cmd_downstack_info(stack, args):
     forest = get_current_downstack_as_forest(stack)
     if args.pr:
-        load_pr_info_for_forest(forest)
+        load_pr_info_for_forest(forest, use_cache=True)
     print_forest(forest)
 
 
@@ -1317,28 +1796,36 @@ def cmd_downstack_sync(stack: StackBranchSet, args):
 
 
 def get_bottom_level_branches_as_forest(stack: StackBranchSet) -> BranchesTreeForest:
-    return BranchesTreeForest(
-        [
-            BranchesTree(
-                {
-                    bottom.name: (
-                        bottom,
-                        BranchesTree({b.name: (b, BranchesTree({})) for b in bottom.children}),
-                    )
-                }
-            )
-            for bottom in stack.bottoms
-        ]
-    )
+    # Only the bottoms and their direct children, the leaves share one empty
+    # subtree as nothing ever modifies a tree once built
+    leaf = BranchesTree({})
+    forest = BranchesTreeForest([])
+    for bottom in stack.bottoms:
+        children = BranchesTree({})
+        for b in bottom.children:
+            children[b.name] = (b, leaf)
+        forest.append(BranchesTree({bottom.name: (bottom, children)}))
+    return forest
 
 
+@functools.lru_cache(maxsize=8)
+def get_remote_url(remote: str) -> str:
+    return run_always_return(CmdArgs(["git", "remote", "get-url", remote]))
+
+
+# host of ssh remotes, both host:path and ssh://host:path styles
+_REMOTE_RE = re.compile(r"^(?:ssh://)?([^/]*):(?!//)")
+
+
+@functools.lru_cache(maxsize=8)
 def get_remote_type(remote: str = "origin") -> Optional[str]:
-    out = run_always_return(CmdArgs(["git", "remote", "-v"]))
-    for l in out.split("\n"):
-        match = re.match(r"^{}\s+(?:ssh://)?([^/]*):(?!//).*\s+\(push\)$".format(remote), l)
-        if match:
-            sshish_host = match.group(1)
-            return sshish_host
+    url = run(CmdArgs(["git", "remote", "get-url", "--push", remote]), check=False)
+    if url is None:
+        return None
+    match = _REMOTE_RE.match(url)
+    if match:
+        sshish_host = match.group(1)
+        return sshish_host
 
     return None
 
@@ -1364,23 +1851,22 @@ def start_muxed_ssh(remote: str = "origin"):
     if hostish is not None:
         info("Creating a muxed ssh connection")
         cmd = gen_ssh_mux_cmd()
-        os.environ["GIT_SSH_COMMAND"] = " ".join(cmd)
+        os.environ["GIT_SSH_COMMAND"] = shlex.join(cmd)
         cmd.append("-MNf")
         cmd.append(hostish)
         # We don't want to use the run() wrapper because
         # we don't want to wait for the process to finish
 
-        p = subprocess.Popen(cmd, stderr=subprocess.PIPE)
-        # Wait a little bit for the connection to establish
-        # before carrying on
-        while p.poll() is None:
-            time.sleep(1)
-        if p.returncode != 0:
+        p = subprocess.Popen(cmd, stderr=subprocess.PIPE, encoding="UTF-8", errors="replace")
+        # With -f ssh goes to the background once the connection is
+        # established, wait for that before carrying on. Don't communicate(),
+        # the backgrounded ssh keeps stderr open.
+        if p.wait() != 0:
             if p.stderr is not None:
                 error = p.stderr.read()
             else:
-                error = b"unknown"
-            die(f"Failed to start ssh muxed connection, error was: {error.decode('utf-8').strip()}")
+                error = "unknown"
+            die(f"Failed to start ssh muxed connection, error was: {error.strip()}")
 
 
 def get_branches_to_delete(forest: BranchesTreeForest) -> List[StackBranch]:
@@ -1423,57 +1909,66 @@ def delete_branches(stack: StackBranchSet, deletes: List[StackBranch]):
             run(CmdArgs(["git", "checkout", new_branch.name]))
             CURRENT_BRANCH = new_branch.name
         run(CmdArgs(["git", "branch", "-D", b.name]))
+    _invalidate_caches()
 
 
 def cleanup_unused_refs(stack: StackBranchSet):
-    # Clean up stacky bottom branch refs
+    # Clean up stacky bottom branch and stack parent refs of branches that are gone
     info("Cleaning up unused refs")
-    stack_bottoms = get_all_stack_bottoms()
-    for bottom in stack_bottoms:
-        if not bottom in stack.stack:
-            ref = "refs/stacky-bottom-branch/{}".format(bottom)
-            info("Deleting ref {}".format(ref))
-            run(CmdArgs(["git", "update-ref", "-d", ref]))
-
-    stack_parent_refs = get_all_stack_parent_refs()
-    for br in stack_parent_refs:
-        if br not in stack.stack:
-            ref = "refs/stack-parent/{}".format(br)
-            old_value = run(CmdArgs(["git", "show-ref", ref]))
-            info("Deleting ref {}".format(old_value))
-            run(CmdArgs(["git", "update-ref", "-d", ref]))
+    prefixes = ["refs/stacky-bottom-branch/", "refs/stack-parent/"]
+    for line in run_lines(
+        CmdArgs(["git", "for-each-ref", "--format", "%(objectname) %(refname)"] + [p[:-1] for p in prefixes])
+    ):
+        commit, _, ref = line.partition(" ")
+        branch = BranchName(ref.split("/", 2)[2])
+        if branch not in stack.stack:
+            info("Deleting ref {} {}".format(commit, ref))
+            GIT_BATCH.delete_ref(ref)
 
 
 def cmd_update(stack: StackBranchSet, args):
     remote = "origin"
     start_muxed_ssh(remote)
-    info("Fetching from {}", remote)
-    run(CmdArgs(["git", "fetch", remote]))
-
-    # TODO(tudor): We should rebase instead of silently dropping
-    # everything you have on local master. Oh well.
-    global CURRENT_BRANCH
-    for b in stack.bottoms:
-        run(
-            CmdArgs(
-                [
-                    "git",
-                    "update-ref",
-                    "refs/heads/{}".format(b.name),
-                    "refs/remotes/{}/{}".format(remote, b.remote_branch),
-                ]
-            )
-        )
-        if b.name == CURRENT_BRANCH:
-            run(CmdArgs(["git", "reset", "--hard", "HEAD"]))
 
     # We treat origin as the source of truth for bottom branches (master), and
     # the local repo as the source of truth for everything else. So we can only
     # track PR closure for branches that are direct descendants of master.
-
-    info("Checking if any PRs have been merged and can be deleted")
+    # What GitHub says about those doesn't depend on what we are about to
+    # fetch, so ask while the fetch is running.
     forest = get_bottom_level_branches_as_forest(stack)
-    load_pr_info_for_forest(forest)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pr_info_loaded = executor.submit(load_pr_info_for_forest, forest)
+
+        info("Fetching from {}", remote)
+        fetch_cmd = ["git", "fetch"]
+        if get_config().write_commit_graph:
+            # Adds what we just fetched to the commit-graph (incrementally), so
+            # that git answers the ancestry checks done when syncing and
+            # landing without parsing every commit
+            fetch_cmd.append("--write-commit-graph")
+        run(CmdArgs(fetch_cmd + [remote]))
+
+        # TODO(tudor): We should rebase instead of silently dropping
+        # everything you have on local master. Oh well.
+        _invalidate_caches()  # the fetch moved the remote-tracking refs
+        # Resolve everything before queuing any update, resolving flushes them
+        remote_commits = []
+        for b in stack.bottoms:
+            remote_ref = "refs/remotes/{}/{}".format(remote, b.remote_branch)
+            commit = GIT_BATCH.resolve(remote_ref)
+            if commit is None:
+                die("{} does not exist", remote_ref)
+            remote_commits.append((b, commit))
+        for b, commit in remote_commits:
+            GIT_BATCH.update_ref("refs/heads/{}".format(b.name), commit)
+        if any(b.name == CURRENT_BRANCH for b in stack.bottoms):
+            # Running git applies the updates first
+            run(CmdArgs(["git", "reset", "--hard", "HEAD"]))
+        GIT_BATCH.flush()
+        _invalidate_caches()
+
+        info("Checking if any PRs have been merged and can be deleted")
+        pr_info_loaded.result()
 
     deletes = get_branches_to_delete(forest)
     if deletes and not args.force:
@@ -1491,10 +1986,22 @@ def cmd_import(stack: StackBranchSet, args):
     branch = args.name
     branches = []
     bottoms = set(b.name for b in stack.bottoms)
+    # The branches of the PRs below this one normally are local branches in
+    # its history (and not yet in a bottom's), ask about those at once rather
+    # than one query per branch down the stack
+    candidates = set([branch])
+    cmd = ["git", "for-each-ref", "--format", "%(refname)", "--merged", branch]
+    for b in sorted(bottoms):
+        cmd += ["--no-merged", b]
+    for ref in run_lines(CmdArgs(cmd + ["refs/heads"]), check=False):
+        candidates.add(BranchName(remove_prefix(ref, "refs/heads/")))
+    pr_infos = get_pr_infos_for_branches(sorted(candidates.difference(bottoms)), full=True)
     while branch not in bottoms:
-        pr_info = get_pr_info(branch, full=True)
-        open_pr = pr_info.open
         info("Getting PR information for {}", branch)
+        if branch not in pr_infos:
+            pr_infos.update(get_pr_infos_for_branches([branch], full=True))
+        pr_info = make_pr_infos(branch, pr_infos[branch])
+        open_pr = pr_info.open
         if open_pr is None:
             die("Branch {} has no open PR", branch)
             # Never reached because the die but makes mypy happy
@@ -1509,7 +2016,9 @@ def cmd_import(stack: StackBranchSet, args):
         if not open_pr["commits"]:
             die("PR #{} has no commits", open_pr["number"])
         first_commit = open_pr["commits"][0]["oid"]
-        parent_commit = Commit(run_always_return(CmdArgs(["git", "rev-parse", "{}^".format(first_commit)])))
+        parent_commit = GIT_BATCH.resolve("{}^".format(first_commit))
+        if parent_commit is None:
+            die("Cannot find the parent of commit {}, first commit of PR #{}", first_commit, open_pr["number"])
         next_branch = open_pr["baseRefName"]
         info(
             "Branch {}: PR #{}, parent is {} at commit {}",
@@ -1527,27 +2036,38 @@ def cmd_import(stack: StackBranchSet, args):
     base_branch = branch
     branches.reverse()
 
-    for b, parent_commit in branches:
-        cout(
-            "- Will set parent of {} to {} at commit {}\n",
-            b,
-            branch,
-            parent_commit,
-        )
-        branch = b
+    # Each branch's parent is the one before it, bottom first
+    parents = [base_branch] + [b for b, _ in branches[:-1]]
+    msg = "".join(
+        fmt("- Will set parent of {} to {} at commit {}\n", b, parent, parent_commit, color=COLOR_STDOUT)
+        for parent, (b, parent_commit) in zip(parents, branches)
+    )
+    sys.stdout.write(msg)
 
     if not args.force:
         confirm()
 
-    branch = base_branch
-    for b, parent_commit in branches:
-        set_parent(b, branch, set_origin=True)
+    for parent, (b, parent_commit) in zip(parents, branches):
+        set_parent(b, parent, set_origin=True)
         set_parent_commit(b, parent_commit)
-        branch = b
 
 
 def get_merge_base(b1: BranchName, b2: BranchName):
-    return run(CmdArgs(["git", "merge-base", str(b1), str(b2)]))
+    commits = []
+    for b in (b1, b2):
+        c = GIT_BATCH.resolve("refs/heads/{}".format(b))
+        if c is None:
+            die("Branch {} does not exist", b)
+        commits.append(c)
+    # Keyed by commit rather than branch name so that it stays valid when
+    # branches move, and in a canonical order as merge-base is symmetric
+    c1, c2 = sorted(commits)
+    return get_commits_merge_base(c1, c2)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_commits_merge_base(c1: Commit, c2: Commit):
+    return run(CmdArgs(["git", "merge-base", c1, c2]))
 
 
 def cmd_adopt(stack: StackBranch, args):
@@ -1579,7 +2099,7 @@ def cmd_adopt(stack: StackBranch, args):
         if branch in FROZEN_STACK_BOTTOMS:
             die("Cannot adopt frozen stack bottoms {}".format(FROZEN_STACK_BOTTOMS))
         # Remove the ref that this is a stack bottom
-        run(CmdArgs(["git", "update-ref", "-d", "refs/stacky-bottom-branch/{}".format(branch)]))
+        GIT_BATCH.delete_ref("refs/stacky-bottom-branch/{}".format(branch))
 
     parent_commit = get_merge_base(CURRENT_BRANCH, branch)
     set_parent(branch, CURRENT_BRANCH, set_origin=True)
@@ -1589,15 +2109,13 @@ def cmd_adopt(stack: StackBranch, args):
 
 
 def cmd_land(stack: StackBranchSet, args):
-    forest = get_current_downstack_as_forest(stack)
-    assert len(forest) == 1
+    # The downstack, bottom first
     branches = []
-    p = forest[0]
-    while p:
-        assert len(p) == 1
-        _, (b, p) = next(iter(p.items()))
-        branches.append(b)
-    assert branches
+    p: Optional[StackBranch] = stack.stack[CURRENT_BRANCH]
+    while p is not None:
+        branches.append(p)
+        p = p.parent
+    branches.reverse()
     assert branches[0] in stack.bottoms
     if len(branches) == 1:
         die("May not land {}", branches[0].name)
@@ -1615,6 +2133,14 @@ def cmd_land(stack: StackBranchSet, args):
             b.name,
         )
 
+    # A recent enough cache entry saying the PR can be merged is good enough:
+    # GitHub refuses the merge anyway if that changed, and --match-head-commit
+    # makes sure we merge what we checked
+    raw_infos = get_cached_pr_infos(b.name, b.commit) if PR_CACHE_ENABLED else None
+    if raw_infos is not None:
+        pr_infos = make_pr_infos(b.name, raw_infos)
+        if pr_infos.open is not None and pr_infos.open["mergeable"] == "MERGEABLE":
+            b.load_pr_info(pr_infos)
     b.load_pr_info()
     pr = b.open_pr_info
     if not pr:
@@ -1647,193 +2173,196 @@ def cmd_land(stack: StackBranchSet, args):
     if not args.force:
         confirm()
 
-    v = run(CmdArgs(["git", "rev-parse", b.name]))
-    assert v is not None
-    head_commit = Commit(v)
-    cmd = CmdArgs(["gh", "pr", "merge", b.name, "--squash", "--match-head-commit", head_commit])
+    # b.commit is what we checked against the remote above
+    cmd = CmdArgs(["gh", "pr", "merge", b.name, "--squash", "--match-head-commit", b.commit])
     if args.auto:
         cmd.append("--auto")
     run(cmd, out=True)
+    forget_pr_cache(b.name)
     cout("\n✓ Success! Run `stacky update` to update local state.\n", fg="green")
 
 
-def main():
-    logging.basicConfig(format=_LOGGING_FORMAT, level=logging.INFO)
-    try:
-        parser = ArgumentParser(description="Handle git stacks")
-        parser.add_argument(
-            "--log-level",
-            default="info",
-            choices=LOGLEVELS.keys(),
-            help="Set the log level",
-        )
-        parser.add_argument(
-            "--color",
-            default="auto",
-            choices=["always", "auto", "never"],
-            help="Colorize output and error",
-        )
-        parser.add_argument(
-            "--remote-name",
-            "-r",
-            default="origin",
-            help="name of the git remote where branches will be pushed",
-        )
-
-        subparsers = parser.add_subparsers(required=True, dest="command")
-
-        # continue
-        continue_parser = subparsers.add_parser("continue", help="Continue previously interrupted command")
-        continue_parser.set_defaults(func=None)
-
-        # down
-        down_parser = subparsers.add_parser("down", help="Go down in the current stack (towards master/main)")
-        down_parser.set_defaults(func=cmd_branch_down)
-        # up
-        up_parser = subparsers.add_parser("up", help="Go up in the current stack (away master/main)")
-        up_parser.set_defaults(func=cmd_branch_up)
-        # info
-        info_parser = subparsers.add_parser("info", help="Stack info")
-        info_parser.add_argument("--pr", action="store_true", help="Get PR info (slow)")
-        info_parser.set_defaults(func=cmd_info)
-
-        # commit
-        commit_parser = subparsers.add_parser("commit", help="Commit")
-        commit_parser.add_argument("-m", help="Commit message", dest="message")
-        commit_parser.add_argument("--amend", action="store_true", help="Amend last commit")
-        commit_parser.add_argument("--allow-empty", action="store_true", help="Allow empty commit")
-        commit_parser.add_argument("--no-edit", action="store_true", help="Skip editor")
-        commit_parser.set_defaults(func=cmd_commit)
-
-        # amend
-        amend_parser = subparsers.add_parser("amend", help="Shortcut for amending last commit")
-        amend_parser.set_defaults(func=cmd_amend)
-
-        # branch
-        branch_parser = subparsers.add_parser("branch", aliases=["b"], help="Operations on branches")
-        branch_subparsers = branch_parser.add_subparsers(required=True, dest="branch_command")
-        branch_up_parser = branch_subparsers.add_parser("up", aliases=["u"], help="Move upstack")
-        branch_up_parser.set_defaults(func=cmd_branch_up)
-
-        branch_down_parser = branch_subparsers.add_parser("down", aliases=["d"], help="Move downstack")
-        branch_down_parser.set_defaults(func=cmd_branch_down)
-
-        branch_new_parser = branch_subparsers.add_parser("new", aliases=["create"], help="Create a new branch")
-        branch_new_parser.add_argument("name", help="Branch name")
-        branch_new_parser.set_defaults(func=cmd_branch_new)
-
-        branch_checkout_parser = branch_subparsers.add_parser("checkout", aliases=["co"], help="Checkout a branch")
-        branch_checkout_parser.add_argument("name", help="Branch name", nargs="?")
-        branch_checkout_parser.set_defaults(func=cmd_branch_checkout)
-
-        # stack
-        stack_parser = subparsers.add_parser("stack", aliases=["s"], help="Operations on the full current stack")
-        stack_subparsers = stack_parser.add_subparsers(required=True, dest="stack_command")
-
-        stack_info_parser = stack_subparsers.add_parser("info", aliases=["i"], help="Info for current stack")
-        stack_info_parser.add_argument("--pr", action="store_true", help="Get PR info (slow)")
-        stack_info_parser.set_defaults(func=cmd_stack_info)
-
-        stack_push_parser = stack_subparsers.add_parser("push", help="Push")
-        stack_push_parser.add_argument("--force", "-f", action="store_true", help="Bypass confirmation")
-        stack_push_parser.add_argument("--no-pr", dest="pr", action="store_false", help="Skip Create PRs")
-        stack_push_parser.set_defaults(func=cmd_stack_push)
-
-        stack_sync_parser = stack_subparsers.add_parser("sync", help="Sync")
-        stack_sync_parser.set_defaults(func=cmd_stack_sync)
-
-        stack_checkout_parser = stack_subparsers.add_parser(
-            "checkout", aliases=["co"], help="Checkout a branch in this stack"
-        )
-        stack_checkout_parser.set_defaults(func=cmd_stack_checkout)
-
-        # upstack
-        upstack_parser = subparsers.add_parser("upstack", aliases=["us"], help="Operations on the current upstack")
-        upstack_subparsers = upstack_parser.add_subparsers(required=True, dest="upstack_command")
-
-        upstack_info_parser = upstack_subparsers.add_parser("info", aliases=["i"], help="Info for current upstack")
-        upstack_info_parser.add_argument("--pr", action="store_true", help="Get PR info (slow)")
-        upstack_info_parser.set_defaults(func=cmd_upstack_info)
-
-        upstack_push_parser = upstack_subparsers.add_parser("push", help="Push")
-        upstack_push_parser.add_argument("--force", "-f", action="store_true", help="Bypass confirmation")
-        upstack_push_parser.add_argument("--no-pr", dest="pr", action="store_false", help="Skip Create PRs")
-        upstack_push_parser.set_defaults(func=cmd_upstack_push)
-
-        upstack_sync_parser = upstack_subparsers.add_parser("sync", help="Sync")
-        upstack_sync_parser.set_defaults(func=cmd_upstack_sync)
-
-        upstack_onto_parser = upstack_subparsers.add_parser("onto", aliases=["restack"], help="Restack")
-        upstack_onto_parser.add_argument("target", help="New parent")
-        upstack_onto_parser.set_defaults(func=cmd_upstack_onto)
-
-        upstack_as_parser = upstack_subparsers.add_parser("as", help="Upstack branch this as a new stack bottom")
-        upstack_as_parser.add_argument("target", help="bottom, restack this branch as a new stack bottom")
-        upstack_as_parser.set_defaults(func=cmd_upstack_as)
-
-        # downstack
-        downstack_parser = subparsers.add_parser(
-            "downstack", aliases=["ds"], help="Operations on the current downstack"
-        )
-        downstack_subparsers = downstack_parser.add_subparsers(required=True, dest="downstack_command")
+def cmd_cache_clear(stack: StackBranchSet, args):
+    for path in (PR_CACHE_FILE, AUTH_CACHE_FILE):
+        Path(path).unlink(missing_ok=True)
+    cout("Cleared cached PR info and `gh` authentication status\n")
+
+
+# An argument: its names and the keyword arguments of add_argument
+ArgumentSpec = Tuple[List[str], Dict[str, Any]]
+# A command: name, aliases, help, arguments, and either the function that runs
+# it or its subcommands
+CommandSpec = Tuple[str, List[str], str, List[ArgumentSpec], Any]
+
+_FORCE_ARGUMENT: ArgumentSpec = (["--force", "-f"], {"action": "store_true", "help": "Bypass confirmation"})
+_NO_PR_ARGUMENT: ArgumentSpec = (["--no-pr"], {"dest": "pr", "action": "store_false", "help": "Skip Create PRs"})
+_PR_ARGUMENT: ArgumentSpec = (["--pr"], {"action": "store_true", "help": "Get PR info (slow)"})
+_PUSH_ARGUMENTS = [_FORCE_ARGUMENT, _NO_PR_ARGUMENT]
+
+_COMMANDS: List[CommandSpec] = [
+    ("continue", [], "Continue previously interrupted command", [], None),
+    ("down", [], "Go down in the current stack (towards master/main)", [], cmd_branch_down),
+    ("up", [], "Go up in the current stack (away master/main)", [], cmd_branch_up),
+    ("info", [], "Stack info", [_PR_ARGUMENT], cmd_info),
+    (
+        "commit",
+        [],
+        "Commit",
+        [
+            (["-m"], {"help": "Commit message", "dest": "message"}),
+            (["--amend"], {"action": "store_true", "help": "Amend last commit"}),
+            (["--allow-empty"], {"action": "store_true", "help": "Allow empty commit"}),
+            (["--no-edit"], {"action": "store_true", "help": "Skip editor"}),
+        ],
+        cmd_commit,
+    ),
+    ("amend", [], "Shortcut for amending last commit", [], cmd_amend),
+    (
+        "branch",
+        ["b"],
+        "Operations on branches",
+        [],
+        [
+            ("up", ["u"], "Move upstack", [], cmd_branch_up),
+            ("down", ["d"], "Move downstack", [], cmd_branch_down),
+            ("new", ["create"], "Create a new branch", [(["name"], {"help": "Branch name"})], cmd_branch_new),
+            (
+                "checkout",
+                ["co"],
+                "Checkout a branch",
+                [(["name"], {"help": "Branch name", "nargs": "?"})],
+                cmd_branch_checkout,
+            ),
+        ],
+    ),
+    (
+        "stack",
+        ["s"],
+        "Operations on the full current stack",
+        [],
+        [
+            ("info", ["i"], "Info for current stack", [_PR_ARGUMENT], cmd_stack_info),
+            ("push", [], "Push", _PUSH_ARGUMENTS, cmd_stack_push),
+            ("sync", [], "Sync", [], cmd_stack_sync),
+            ("checkout", ["co"], "Checkout a branch in this stack", [], cmd_stack_checkout),
+        ],
+    ),
+    (
+        "upstack",
+        ["us"],
+        "Operations on the current upstack",
+        [],
+        [
+            ("info", ["i"], "Info for current upstack", [_PR_ARGUMENT], cmd_upstack_info),
+            ("push", [], "Push", _PUSH_ARGUMENTS, cmd_upstack_push),
+            ("sync", [], "Sync", [], cmd_upstack_sync),
+            ("onto", ["restack"], "Restack", [(["target"], {"help": "New parent"})], cmd_upstack_onto),
+            (
+                "as",
+                [],
+                "Upstack branch this as a new stack bottom",
+                [(["target"], {"help": "bottom, restack this branch as a new stack bottom"})],
+                cmd_upstack_as,
+            ),
+        ],
+    ),
+    (
+        "downstack",
+        ["ds"],
+        "Operations on the current downstack",
+        [],
+        [
+            ("info", ["i"], "Info for current downstack", [_PR_ARGUMENT], cmd_downstack_info),
+            ("push", [], "Push", _PUSH_ARGUMENTS, cmd_downstack_push),
+            ("sync", [], "Sync", [], cmd_downstack_sync),
+        ],
+    ),
+    ("update", [], "Update repo, all bottom branches must exist in remote", [_FORCE_ARGUMENT], cmd_update),
+    (
+        "cache",
+        [],
+        "Manage stacky's local caches",
+        [],
+        [("clear", [], "Forget cached PR info and `gh` authentication", [], cmd_cache_clear)],
+    ),
+    (
+        "import",
+        [],
+        "Import Graphite stack",
+        [_FORCE_ARGUMENT, (["name"], {"help": "Foreign stack top"})],
+        cmd_import,
+    ),
+    ("adopt", [], "Adopt one branch", [(["name"], {"help": "Branch name"})], cmd_adopt),
+    (
+        "land",
+        [],
+        "Land bottom-most PR on current stack",
+        [
+            _FORCE_ARGUMENT,
+            (["--auto", "-a"], {"action": "store_true", "help": "Automatically merge after all checks pass"}),
+        ],
+        cmd_land,
+    ),
+    # shortcuts
+    ("push", [], "Alias for downstack push", _PUSH_ARGUMENTS, cmd_downstack_push),
+    ("sync", [], "Alias for stack sync", [], cmd_stack_sync),
+    ("checkout", ["co"], "Checkout a branch", [(["name"], {"help": "Branch name", "nargs": "?"})], cmd_branch_checkout),
+    ("sco", [], "Checkout a branch in this stack", [], cmd_stack_checkout),
+]
+
+
+# Commands that only touch stacky's own files, they run without a repo and get
+# an empty stack
+_COMMANDS_WITHOUT_REPO = frozenset([cmd_cache_clear])
+
+
+def _add_commands(subparsers, commands: List[CommandSpec]):
+    for name, aliases, help, arguments, func in commands:
+        parser = subparsers.add_parser(name, aliases=aliases, help=help)
+        for names, kwargs in arguments:
+            parser.add_argument(*names, **kwargs)
+        if isinstance(func, list):
+            _add_commands(parser.add_subparsers(required=True, dest="{}_command".format(name)), func)
+        else:
+            parser.set_defaults(func=func, needs_repo=func not in _COMMANDS_WITHOUT_REPO)
 
-        downstack_info_parser = downstack_subparsers.add_parser(
-            "info", aliases=["i"], help="Info for current downstack"
-        )
-        downstack_info_parser.add_argument("--pr", action="store_true", help="Get PR info (slow)")
-        downstack_info_parser.set_defaults(func=cmd_downstack_info)
-
-        downstack_push_parser = downstack_subparsers.add_parser("push", help="Push")
-        downstack_push_parser.add_argument("--force", "-f", action="store_true", help="Bypass confirmation")
-        downstack_push_parser.add_argument("--no-pr", dest="pr", action="store_false", help="Skip Create PRs")
-        downstack_push_parser.set_defaults(func=cmd_downstack_push)
-
-        downstack_sync_parser = downstack_subparsers.add_parser("sync", help="Sync")
-        downstack_sync_parser.set_defaults(func=cmd_downstack_sync)
-
-        # update
-        update_parser = subparsers.add_parser("update", help="Update repo, all bottom branches must exist in remote")
-        update_parser.add_argument("--force", "-f", action="store_true", help="Bypass confirmation")
-        update_parser.set_defaults(func=cmd_update)
-
-        # import
-        import_parser = subparsers.add_parser("import", help="Import Graphite stack")
-        import_parser.add_argument("--force", "-f", action="store_true", help="Bypass confirmation")
-        import_parser.add_argument("name", help="Foreign stack top")
-        import_parser.set_defaults(func=cmd_import)
-
-        # adopt
-        adopt_parser = subparsers.add_parser("adopt", help="Adopt one branch")
-        adopt_parser.add_argument("name", help="Branch name")
-        adopt_parser.set_defaults(func=cmd_adopt)
-
-        # land
-        land_parser = subparsers.add_parser("land", help="Land bottom-most PR on current stack")
-        land_parser.add_argument("--force", "-f", action="store_true", help="Bypass confirmation")
-        land_parser.add_argument(
-            "--auto",
-            "-a",
-            action="store_true",
-            help="Automatically merge after all checks pass",
-        )
-        land_parser.set_defaults(func=cmd_land)
 
-        # shortcuts
-        push_parser = subparsers.add_parser("push", help="Alias for downstack push")
-        push_parser.add_argument("--force", "-f", action="store_true", help="Bypass confirmation")
-        push_parser.add_argument("--no-pr", dest="pr", action="store_false", help="Skip Create PRs")
-        push_parser.set_defaults(func=cmd_downstack_push)
+def _build_parser() -> ArgumentParser:
+    parser = ArgumentParser(description="Handle git stacks")
+    parser.add_argument(
+        "--log-level",
+        default="info",
+        choices=LOGLEVELS.keys(),
+        help="Set the log level",
+    )
+    parser.add_argument(
+        "--color",
+        default="auto",
+        choices=["always", "auto", "never"],
+        help="Colorize output and error",
+    )
+    parser.add_argument(
+        "--remote-name",
+        "-r",
+        default="origin",
+        help="name of the git remote where branches will be pushed",
+    )
+    parser.add_argument(
+        "--no-pr-cache",
+        dest="pr_cache",
+        action="store_false",
+        help="Always ask GitHub for PR info instead of using the local cache",
+    )
 
-        sync_parser = subparsers.add_parser("sync", help="Alias for stack sync")
-        sync_parser.set_defaults(func=cmd_stack_sync)
+    _add_commands(parser.add_subparsers(required=True, dest="command"), _COMMANDS)
 
-        checkout_parser = subparsers.add_parser("checkout", aliases=["co"], help="Checkout a branch")
-        checkout_parser.add_argument("name", help="Branch name", nargs="?")
-        checkout_parser.set_defaults(func=cmd_branch_checkout)
+    return parser
 
-        checkout_parser = subparsers.add_parser("sco", help="Checkout a branch in this stack")
-        checkout_parser.set_defaults(func=cmd_stack_checkout)
 
+def main():
+    logging.basicConfig(format=_LOGGING_FORMAT, level=logging.INFO)
+    try:
+        parser = _build_parser()
         args = parser.parse_args()
         logging.basicConfig(format=_LOGGING_FORMAT, level=LOGLEVELS[args.log_level], force=True)
 
@@ -1846,27 +2375,40 @@ def main():
             COLOR_STDERR = False
             COLOR_STDOUT = False
 
-        init_git()
+        global PR_CACHE_ENABLED
+        PR_CACHE_ENABLED = args.pr_cache
 
         stack = StackBranchSet()
-        load_all_stacks(stack)
+        if args.needs_repo:
+            init_git()
+            load_all_stacks(stack)
 
         global CURRENT_BRANCH
-        if args.command == "continue":
+        if not args.needs_repo:
+            args.func(stack, args)
+        elif args.command == "continue":
             try:
-                with open(STATE_FILE) as f:
-                    state = json.load(f)
+                with open(STATE_FILE, "rb") as f:
+                    state = parse_sync_state(json_loads(f.read()))
             except FileNotFoundError as e:  # noqa: F841
                 die("No previous command in progress")
-            branch = state["branch"]
-            run(["git", "checkout", branch])
-            CURRENT_BRANCH = branch
-            if CURRENT_BRANCH not in stack.stack:
-                die("Current branch {} is not in a stack", CURRENT_BRANCH)
-
-            sync_names = state["sync"]
+            except (ValueError, TypeError, KeyError) as e:
+                die("Invalid state file {}: {}", STATE_FILE, e)
+            branch = state.branch
+            sync_names = state.sync
+            # stack.stack is a dict: check everything before touching the
+            # work tree, and give a proper error rather than a KeyError
+            if branch not in stack.stack:
+                die("Current branch {} is not in a stack", branch)
+            missing = [n for n in sync_names if n not in stack.stack]
+            if missing:
+                die("Cannot resume, branches not in a stack anymore: {}", ", ".join(missing))
             syncs = [stack.stack[n] for n in sync_names]
 
+            if branch != CURRENT_BRANCH:
+                run(CmdArgs(["git", "switch", "--no-guess", branch]))
+            CURRENT_BRANCH = branch
+
             inner_do_sync(syncs, sync_names)
         else:
             # TODO restore the current branch after changing the branch on some commands for
@@ -1875,7 +2417,7 @@ def main():
                 main_branch = get_real_stack_bottom()
 
                 if get_config().change_to_main and main_branch is not None:
-                    run(["git", "checkout", main_branch])
+                    run(CmdArgs(["git", "switch", "--no-guess", main_branch]))
                     CURRENT_BRANCH = main_branch
                 else:
                     die("Current branch {} is not in a stack", CURRENT_BRANCH)
@@ -1883,14 +2425,32 @@ def main():
             get_current_stack_as_forest(stack)
             args.func(stack, args)
 
-        # Success, delete the state file
-        try:
-            os.remove(STATE_FILE)
-        except FileNotFoundError:
-            pass
     except ExitException as e:
         error("{}", e.args[0])
+        close_git_batch()
+        sys.exit(1)
+    except BaseException:
+        # Ctrl-C or a bug, don't lose track of what was already done (like
+        # the parent commits of the branches already synced)
+        close_git_batch()
+        raise
+
+    if not close_git_batch():
         sys.exit(1)
+    # Success, delete the state file
+    if args.needs_repo:
+        Path(STATE_FILE).unlink(missing_ok=True)
+
+
+def close_git_batch() -> bool:
+    # Apply the ref updates queued so far, they would have been made right
+    # away if we weren't batching them
+    try:
+        GIT_BATCH.close()
+    except ExitException as e:
+        error("{}", e.args[0])
+        return False
+    return True
 
 
 if __name__ == "__main__":
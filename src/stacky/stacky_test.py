@@ -1,19 +1,43 @@
 #!/usr/bin/env python3
+import json
 import os
+import re
 import shlex
 import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 from unittest import mock
 from unittest.mock import MagicMock, patch
 
+import stacky
 from stacky import (
+    SYNC_STATE_VERSION,
     PRInfos,
+    ExitException,
+    GitBatch,
+    StackBranchSet,
+    SyncState,
     _check_returncode,
+    _invalidate_branch_config,
+    _invalidate_caches,
+    _load_branch_config,
     cmd_land,
     find_issue_marker,
+    get_cached_pr_infos,
+    get_pr_infos_for_branches,
     get_top_level_dir,
+    inner_do_sync,
+    load_all_stacks,
+    parse_sync_state,
     read_config,
+    render_tree,
+    run,
+    run_lines,
+    save_pr_cache,
     stop_muxed_ssh,
+    update_pr_cache,
 )
 
 
@@ -26,17 +50,67 @@ class TestCheckReturnCode(unittest.TestCase):
 
     @patch("stacky.die")
     def test_check_returncode_negative(self, mock_die):
-        sp = subprocess.CompletedProcess(args=["ls"], returncode=-1, stderr=b"error")
+        sp = subprocess.CompletedProcess(args=["ls"], returncode=-1, stderr="error")
         _check_returncode(sp, ["ls"])
         mock_die.assert_called_once_with("Killed by signal {}: {}. Stderr was:\n{}", 1, shlex.join(["ls"]), "error")
 
     @patch("stacky.die")
     def test_check_returncode_positive(self, mock_die):
-        sp = subprocess.CompletedProcess(args=["ls"], returncode=1, stderr=b"error")
+        sp = subprocess.CompletedProcess(args=["ls"], returncode=1, stderr="error")
         _check_returncode(sp, ["ls"])
         mock_die.assert_called_once_with("Exited with status {}: {}. Stderr was:\n{}", 1, shlex.join(["ls"]), "error")
 
 
+class TestRunLines(unittest.TestCase):
+    def test_run_lines_large_stderr(self):
+        # More than a pipe buffer of stderr, written before stdout is closed
+        cmd = [sys.executable, "-c", "import sys; sys.stderr.write('x' * 200000); sys.stderr.flush(); print('a')"]
+        result = []
+        thread = threading.Thread(target=lambda: result.append(run_lines(cmd)), daemon=True)
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), "run_lines deadlocked")
+        self.assertEqual(result, [["a"]])
+
+    @patch("stacky.die")
+    def test_run_lines_failure(self, mock_die):
+        cmd = [sys.executable, "-c", "import sys; print('a'); sys.exit('oops')"]
+        self.assertEqual(run_lines(cmd), [])
+        mock_die.assert_called_once_with("Exited with status {}: {}. Stderr was:\n{}", 1, shlex.join(cmd), "oops\n")
+
+
+class TestLoadBranchConfig(unittest.TestCase):
+    def setUp(self):
+        _invalidate_branch_config()
+
+    def tearDown(self):
+        _invalidate_branch_config()
+
+    @patch("stacky.run_lines")
+    def test_load_branch_config(self, mock_run_lines):
+        mock_run_lines.return_value = [
+            "branch.master.remote origin",
+            "branch.master.merge refs/heads/master",
+            "branch.feature.v1.2.remote .",
+            "branch.feature.v1.2.merge refs/heads/master",
+        ]
+        cfg = _load_branch_config()
+        self.assertEqual(
+            cfg,
+            {
+                "master": {"remote": "origin", "merge": "refs/heads/master"},
+                "feature.v1.2": {"remote": ".", "merge": "refs/heads/master"},
+            },
+        )
+        # Cached until invalidated
+        _load_branch_config()
+        mock_run_lines.assert_called_once()
+
+    @patch("stacky.run_lines", return_value=[])
+    def test_load_branch_config_empty(self, mock_run_lines):
+        self.assertEqual(_load_branch_config(), {})
+
+
 class TestStringMethods(unittest.TestCase):
     def test_find_issue_marker(self):
         out = find_issue_marker("SRE-12")
@@ -83,25 +157,26 @@ class TestStringMethods(unittest.TestCase):
 
 
 class TestCmdLand(unittest.TestCase):
+    @patch("stacky.get_cached_pr_infos", return_value=None)
+    @patch("stacky.forget_pr_cache")
+    @patch("stacky.CURRENT_BRANCH", "branch_name", create=True)
     @patch("stacky.COLOR_STDOUT", True)
     @patch("sys.stdout.write")
-    @patch("stacky.get_current_downstack_as_forest")
     @patch("stacky.die")
     @patch("stacky.cout")
     @patch("stacky.confirm")
     @patch("stacky.run")
     @patch("stacky.CmdArgs")
-    @patch("stacky.Commit")
     def test_cmd_land(
         self,
-        mock_Commit,
         mock_CmdArgs,
         mock_run,
         mock_confirm,
         mock_cout,
         mock_die,
-        mock_get_current_downstack_as_forest,
         mock_write,
+        mock_forget_pr_cache,
+        mock_get_cached_pr_infos,
     ):
         # Mock the args
         args = MagicMock()
@@ -110,10 +185,7 @@ class TestCmdLand(unittest.TestCase):
 
         bottom_branch = MagicMock()
         bottom_branch.name = "bottom_branch"
-
-        # Mock the stack
-        stack = MagicMock()
-        stack.bottoms = [bottom_branch]
+        bottom_branch.parent = None
 
         # Mock the branch
         branch = MagicMock()
@@ -122,33 +194,335 @@ class TestCmdLand(unittest.TestCase):
         branch.load_pr_info.return_value = None
         branch.open_pr_info = {"mergeable": "MERGEABLE", "number": 1, "url": "http://example.com"}
         branch.name = "branch_name"
-        branch.parent.name = "parent_name"
+        branch.commit = "commit"
+        branch.parent = bottom_branch
 
-        # Mock the forest and branches
-        mock_get_current_downstack_as_forest.return_value = [
-            {"bottom_branch": (bottom_branch, {"branch": (branch, None)})}
-        ]
+        # Mock the stack
+        stack = MagicMock()
+        stack.bottoms = [bottom_branch]
+        stack.stack = {"bottom_branch": bottom_branch, "branch_name": branch}
 
         # Mock the CmdArgs
         mock_CmdArgs.return_value = ["cmd_args"]
 
-        # Mock the Commit
-        mock_Commit.return_value = "commit"
-
         # Call the function
         cmd_land(stack, args)
 
         # Assert the mocks were called correctly
-        mock_get_current_downstack_as_forest.assert_called_once_with(stack)
         branch.is_synced_with_parent.assert_called_once()
         branch.is_synced_with_remote.assert_called_once()
-        branch.load_pr_info.assert_called_once()
+        branch.load_pr_info.assert_called_once_with()
         mock_write.assert_called_with(
-            "- Will land PR #1 (\x1b[34mhttp://example.com\x1b[0m) for branch branch_name into branch parent_name\n"
+            "- Will land PR #1 (\x1b[34mhttp://example.com\x1b[0m) for branch branch_name into branch bottom_branch\n"
+        )
+        mock_CmdArgs.assert_called_once_with(
+            ["gh", "pr", "merge", "branch_name", "--squash", "--match-head-commit", "commit"]
         )
         mock_run.assert_called_with(["cmd_args"], out=True)
+        mock_forget_pr_cache.assert_called_once_with("branch_name")
         mock_cout.assert_called_with("\n✓ Success! Run `stacky update` to update local state.\n", fg="green")
 
+    @patch("stacky.forget_pr_cache")
+    @patch("stacky.CURRENT_BRANCH", "branch_name", create=True)
+    @patch("sys.stdout.write")
+    @patch("stacky.cout")
+    @patch("stacky.run")
+    @patch("stacky.get_cached_pr_infos")
+    def test_cmd_land_cached_pr_info(self, mock_get_cached_pr_infos, mock_run, mock_cout, mock_write, mock_forget):
+        args = MagicMock(force=True, auto=False)
+        # parent is a MagicMock constructor argument, set it afterwards
+        bottom_branch = MagicMock()
+        bottom_branch.parent = None
+        branch = MagicMock(commit="commit")
+        branch.name = "branch_name"
+        branch.parent = bottom_branch
+        stack = MagicMock(bottoms=[bottom_branch], stack={"branch_name": branch})
+        pr = {"id": "1", "state": "OPEN", "mergeable": "MERGEABLE", "number": 1, "url": "http://example.com"}
+        mock_get_cached_pr_infos.return_value = [pr]
+        branch.open_pr_info = pr
+
+        cmd_land(stack, args)
+
+        mock_get_cached_pr_infos.assert_called_once_with("branch_name", "commit")
+        branch.load_pr_info.assert_any_call(PRInfos({"1": pr}, pr))
+
+
+class TestPRCache(unittest.TestCase):
+    @patch("stacky.time.time", return_value=1000.0)
+    @patch("stacky.get_pr_cache")
+    def test_get_cached_pr_infos(self, mock_get_pr_cache, mock_time):
+        infos = [{"id": "1"}]
+        mock_get_pr_cache.return_value = {"fresh": ("c1", infos, 900.0), "stale": ("c1", infos, 100.0)}
+        self.assertEqual(get_cached_pr_infos("fresh", "c1"), infos)
+        # The branch moved since
+        self.assertIsNone(get_cached_pr_infos("fresh", "c2"))
+        # Too old, the PR may have changed on GitHub
+        self.assertIsNone(get_cached_pr_infos("stale", "c1"))
+        self.assertIsNone(get_cached_pr_infos("unknown", "c1"))
+
+    @patch("stacky.time.time", return_value=1000.0)
+    @patch("stacky._GIT_COMMON_DIR", "/repo/b/.git")
+    @patch("stacky._PR_CACHE_DIRTY", False)
+    @patch("stacky._PR_CACHE", None)
+    @patch("stacky.atexit.register")
+    def test_pr_cache_file(self, mock_register, mock_time):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "prcache.json")
+            with open(path, "w") as f:
+                json.dump(
+                    {"/repo/a/.git": {"x": ["c1", [{"id": "1"}], 900.0]}, "/repo/c/.git": {"x": ["c1", [], 1.0]}}, f
+                )
+            with patch("stacky.PR_CACHE_FILE", path):
+                # Another repo's branch with the same name and commit
+                self.assertIsNone(get_cached_pr_infos("x", "c1"))
+                update_pr_cache("x", "c1", [{"id": "2"}])
+                save_pr_cache()
+            with open(path) as f:
+                saved = json.load(f)
+        # The expired entry of the third repo is gone
+        self.assertEqual(
+            saved,
+            {"/repo/a/.git": {"x": ["c1", [{"id": "1"}], 900.0]}, "/repo/b/.git": {"x": ["c1", [{"id": "2"}], 1000.0]}},
+        )
+
+
+class TestGetPRInfosForBranches(unittest.TestCase):
+    def setUp(self):
+        self.queries = []
+
+    def fake_gh(self, cmd):
+        # Answers like GitHub would: one PR per aliased branch, its head being
+        # that branch
+        query = cmd[-1]
+        self.queries.append(query)
+        repository = {}
+        for alias, name in re.findall(r'(b\d+): pullRequests\(headRefName: ("(?:[^"\\]|\\.)*")', query):
+            branch = json.loads(name)
+            pr = {"id": branch, "state": "OPEN", "headRefName": branch}
+            if "commits(first: 1)" in query:
+                pr["commits"] = {"nodes": [{"commit": {"oid": "sha-" + branch}}]}
+            repository[alias] = {"nodes": [pr]}
+        return json.dumps({"data": {"repository": repository}})
+
+    @patch("stacky.PR_QUERY_BRANCHES", 2)
+    def test_chunks(self):
+        branches = ["a", "b", 'quote"d', "d", "e"]
+        with patch("stacky.run_always_return", side_effect=self.fake_gh):
+            by_branch = get_pr_infos_for_branches(branches)
+        # Every branch gets its own PRs back, whichever request it was in
+        self.assertEqual(len(self.queries), 3)
+        self.assertEqual(
+            {b: [pr["headRefName"] for pr in prs] for b, prs in by_branch.items()}, {b: [b] for b in branches}
+        )
+        for query in self.queries:
+            self.assertNotIn("b2:", query)
+
+    def test_full(self):
+        with patch("stacky.run_always_return", side_effect=self.fake_gh):
+            by_branch = get_pr_infos_for_branches(["a"], full=True)
+        # Shaped like `gh pr list --json commits`
+        self.assertEqual(by_branch["a"][0]["commits"], [{"oid": "sha-a"}])
+
+
+class TestSyncState(unittest.TestCase):
+    def test_parse_sync_state(self):
+        state = parse_sync_state({"branch": "c", "sync": ["a", "b"], "version": SYNC_STATE_VERSION})
+        self.assertEqual(state, SyncState("c", ["a", "b"]))
+
+    @patch("stacky.info")
+    def test_parse_sync_state_unversioned(self, mock_info):
+        # Written before the version field, in reverse sync order
+        state = parse_sync_state({"branch": "c", "sync": ["b", "a"]})
+        self.assertEqual(state, SyncState("c", ["a", "b"]))
+        mock_info.assert_called_once()
+
+    def test_parse_sync_state_unknown_version(self):
+        with self.assertRaises(ValueError):
+            parse_sync_state({"branch": "c", "sync": ["a"], "version": SYNC_STATE_VERSION + 1})
+        with self.assertRaises(ValueError):
+            parse_sync_state(["c"])
+
+
+class GitRepoTestCase(unittest.TestCase):
+    """Runs each test in a scratch git repo with a fresh GitBatch"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(tmp.name)
+        self.addCleanup(os.chdir, cwd)
+        self.git("init", "-q", "-b", "master")
+        self.git("config", "user.name", "Test")
+        self.git("config", "user.email", "test@example.com")
+        self.master = self.commit("f", "1")
+
+        batch = GitBatch()
+        patcher = patch("stacky.GIT_BATCH", batch)
+        patcher.start()
+        # Stop the patch last, close() may still need to flush
+        self.addCleanup(patcher.stop)
+        self.addCleanup(batch.close)
+        self.addCleanup(_invalidate_caches)
+        _invalidate_caches()
+
+    def git(self, *args: str) -> str:
+        return subprocess.run(["git", *args], check=True, capture_output=True, text=True).stdout.strip()
+
+    def commit(self, path: str, contents: str) -> str:
+        with open(path, "w") as f:
+            f.write(contents)
+        self.git("add", path)
+        self.git("commit", "-q", "-m", "{} {}".format(path, contents))
+        return self.git("rev-parse", "HEAD")
+
+    def ref(self, ref: str):
+        # Straight from git, bypassing anything GitBatch has queued
+        sp = subprocess.run(["git", "rev-parse", "-q", "--verify", ref], capture_output=True, text=True)
+        return sp.stdout.strip() or None
+
+
+class TestGitBatch(GitRepoTestCase):
+    def test_updates_are_applied_before_other_git_commands(self):
+        stacky.GIT_BATCH.update_ref("refs/heads/x", self.master, "")
+        # Queued, git doesn't know yet...
+        self.assertIsNone(self.ref("refs/heads/x"))
+        # ...but any git command we run sees it
+        self.assertEqual(run(["git", "rev-parse", "refs/heads/x"]), self.master)
+
+    def test_resolve_sees_queued_updates(self):
+        stacky.GIT_BATCH.update_ref("refs/heads/x", self.master, "")
+        self.assertEqual(stacky.GIT_BATCH.resolve("refs/heads/x"), self.master)
+        stacky.GIT_BATCH.delete_ref("refs/heads/x")
+        self.assertIsNone(stacky.GIT_BATCH.resolve("refs/heads/x"))
+        # Asking git itself flushes first
+        stacky.GIT_BATCH.forget()
+        self.assertIsNone(stacky.GIT_BATCH.resolve("refs/heads/x"))
+        self.assertEqual(stacky.GIT_BATCH.resolve("refs/heads/master"), self.master)
+        self.assertIsNone(stacky.GIT_BATCH.resolve("refs/heads/nope"))
+
+    def test_same_ref_updated_twice(self):
+        second = self.commit("f", "2")
+        # A ref can only appear once in an update-ref transaction
+        stacky.GIT_BATCH.update_ref("refs/stack-parent/x", self.master, "")
+        stacky.GIT_BATCH.update_ref("refs/stack-parent/x", second, self.master)
+        stacky.GIT_BATCH.close()
+        self.assertEqual(self.ref("refs/stack-parent/x"), second)
+
+    def test_close_applies_updates(self):
+        # Non-ASCII ref names go through update-ref -z untouched
+        stacky.GIT_BATCH.update_ref("refs/heads/\u00e9t\u00e9", self.master)
+        stacky.GIT_BATCH.update_ref("refs/heads/y", self.master)
+        stacky.GIT_BATCH.close()
+        self.assertEqual(self.ref("refs/heads/\u00e9t\u00e9"), self.master)
+        self.assertEqual(self.ref("refs/heads/y"), self.master)
+
+    @patch("stacky.stop_muxed_ssh")
+    def test_failed_update_dies(self, mock_stop_muxed_ssh):
+        # "" as the previous commit: the ref must not exist yet
+        stacky.GIT_BATCH.update_ref("refs/heads/master", self.master, "")
+        with self.assertRaises(ExitException):
+            stacky.GIT_BATCH.flush()
+
+
+class TestMainAppliesQueuedUpdates(GitRepoTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, value in [
+            ("sys.argv", ["stacky", "--color", "never", "info"]),
+            ("stacky.STATE_FILE", os.path.join(os.getcwd(), "state")),
+            ("stacky.STACK_BOTTOMS", stacky.FROZEN_STACK_BOTTOMS),
+            ("stacky.init_git", lambda: setattr(stacky, "CURRENT_BRANCH", "master")),
+            ("stacky.stop_muxed_ssh", lambda *args: None),
+        ]:
+            patcher = patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fail_with(self, exception):
+        def command(stack):
+            stacky.set_parent_commit("x", self.master)
+            raise exception
+
+        return patch("stacky.get_current_stack_as_forest", command)
+
+    def test_exit_exception(self):
+        with self.fail_with(ExitException("boom")), self.assertRaises(SystemExit):
+            stacky.main()
+        self.assertEqual(self.ref("refs/stack-parent/x"), self.master)
+
+    def test_keyboard_interrupt(self):
+        with self.fail_with(KeyboardInterrupt()), self.assertRaises(KeyboardInterrupt):
+            stacky.main()
+        self.assertEqual(self.ref("refs/stack-parent/x"), self.master)
+
+
+class TestInnerDoSync(GitRepoTestCase):
+    def setUp(self):
+        super().setUp()
+        # master <- a <- b
+        for branch, parent in [("a", "master"), ("b", "a")]:
+            self.git("checkout", "-q", "-b", branch)
+            self.git("config", "branch.{}.remote".format(branch), ".")
+            self.git("config", "branch.{}.merge".format(branch), "refs/heads/{}".format(parent))
+            self.git("update-ref", "refs/stack-parent/{}".format(branch), parent)
+            self.commit(branch if branch == "a" else "f", branch)
+        self.old_a = self.git("rev-parse", "a")
+        self.git("checkout", "-q", "master")
+
+        self.state_file = os.path.join(os.getcwd(), "state")
+        for name, value in [
+            ("stacky.get_config", MagicMock(return_value=MagicMock(use_merge=False))),
+            ("stacky.CURRENT_BRANCH", "master"),
+            ("stacky.STATE_FILE", self.state_file),
+            ("stacky.STACK_BOTTOMS", stacky.FROZEN_STACK_BOTTOMS),
+            ("stacky.stop_muxed_ssh", lambda *args: None),
+            ("stacky.cout", lambda *args, **kwargs: None),
+        ]:
+            patcher = patch(name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sync(self):
+        stack = StackBranchSet()
+        load_all_stacks(stack)
+        syncs = [stack.stack["a"], stack.stack["b"]]
+        inner_do_sync(syncs, [b.name for b in syncs])
+
+    def test_sync(self):
+        new_master = self.commit("m", "2")
+        self.sync()
+        new_a = self.git("rev-parse", "a")
+        self.assertEqual(self.git("rev-parse", "a^"), new_master)
+        self.assertEqual(self.git("rev-parse", "b^"), new_a)
+        self.assertEqual(self.ref("refs/stack-parent/a"), new_master)
+        self.assertEqual(self.ref("refs/stack-parent/b"), new_a)
+
+    def test_sync_conflict(self):
+        # b changes f too, rebasing it fails
+        new_master = self.commit("f", "2")
+        with self.assertRaises(ExitException):
+            self.sync()
+        stacky.GIT_BATCH.close()
+        # a was synced and that is recorded, b is left for `stacky continue`
+        self.assertEqual(self.ref("refs/stack-parent/a"), new_master)
+        self.assertEqual(self.ref("refs/stack-parent/b"), self.old_a)
+        with open(self.state_file) as f:
+            self.assertEqual(parse_sync_state(stacky.json_loads(f.read())), SyncState("master", ["b"]))
+
+    @patch("stacky.get_config", return_value=MagicMock(use_merge=True))
+    def test_sync_merge_checkout_fails(self, mock_get_config):
+        self.commit("m", "2")
+        # Checking out a would overwrite this untracked file
+        with open("a", "w") as f:
+            f.write("untracked")
+        with self.assertRaises(ExitException):
+            self.sync()
+        # Nothing was merged yet, `stacky continue` redoes both branches
+        self.assertEqual(self.git("rev-parse", "a"), self.old_a)
+        with open(self.state_file) as f:
+            self.assertEqual(parse_sync_state(stacky.json_loads(f.read())), SyncState("master", ["a", "b"]))
+
 
 class TestStopMuxedSsh(unittest.TestCase):
     @patch("stacky.get_config", return_value=MagicMock(share_ssh_session=True))
@@ -176,5 +550,36 @@ class TestStopMuxedSsh(unittest.TestCase):
         mock_popen.assert_not_called()
 
 
+class TestRenderTree(unittest.TestCase):
+    def make_node(self, name, *children):
+        b = MagicMock(open_pr_info=None)
+        b.name = name
+        b.is_synced_with_parent.return_value = True
+        b.is_synced_with_remote.return_value = True
+        return name, (b, dict(children))
+
+    @patch("stacky.CURRENT_BRANCH", "d", create=True)
+    def test_render_tree(self):
+        tree = dict(
+            [
+                self.make_node(
+                    "master",
+                    self.make_node("a", self.make_node("b"), self.make_node("c")),
+                    self.make_node("d"),
+                )
+            ]
+        )
+        self.assertEqual(
+            render_tree(tree),
+            [
+                "master",
+                " \u251c\u2500\u2500 a",
+                " \u2502   \u251c\u2500\u2500 b",
+                " \u2502   \u250c\u2500\u2500 c",
+                " \u250c\u2500\u2500 * d",
+            ],
+        )
+
+
 if __name__ == "__main__":
     unittest.main()